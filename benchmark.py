@@ -0,0 +1,775 @@
+import io
+import os
+import sys
+import time
+import zipfile
+import argparse
+import tempfile
+import itertools
+
+import insert_images_wps_embedded as wps
+
+SEED_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'img')
+SEED_IMAGES = [
+    os.path.join(SEED_DIR, f'test_image_{i}.png') for i in range(1, 6)
+]
+# 仓库自带img/目录下的全部图片
+BUNDLED_IMAGES = sorted(
+    os.path.join(SEED_DIR, name) for name in os.listdir(SEED_DIR)
+    if name.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))
+)
+
+
+# 按行列网格把图片依次分配到单元格
+def grid_mapping(images, columns=100):
+    for i, image in enumerate(images):
+        row, col = divmod(i, columns)
+        yield None, wps.rowcol_to_cell(row, col), image
+
+
+# 循环使用样本图片生成N个内容互不相同的文件（在文件末尾追加序号），
+# 避免相同图片去重让测试结果失真
+def make_corpus(directory, count, seed_images):
+    seeds = []
+    for path in seed_images:
+        with open(path, 'rb') as f:
+            seeds.append((os.path.splitext(path)[1], f.read()))
+
+    images = []
+    for i, (ext, data) in zip(range(count), itertools.cycle(seeds)):
+        path = os.path.join(directory, f'{i}{ext}')
+        with open(path, 'wb') as f:
+            f.write(data)
+            f.write(i.to_bytes(8, 'little'))
+        images.append(path)
+    return images
+
+
+# 生成N张像素内容互不相同的大尺寸照片，轮流保存为PNG、JPEG和BMP
+def make_photo_corpus(directory, count, size):
+    from PIL import Image
+
+    with Image.open(SEED_IMAGES[0]) as seed:
+        photo = seed.convert('RGB').resize(size)
+
+    images = []
+    formats = itertools.cycle([('.png', 'PNG'), ('.jpg', 'JPEG'), ('.bmp', 'BMP')])
+    for i, (ext, image_format) in zip(range(count), formats):
+        # 每张照片画一个不同颜色的色块，保证缩小后的结果也不会被去重
+        block = Image.new('RGB', (64, 64), (i * 37 % 256, i * 91 % 256, i % 256))
+        photo.paste(block, (i * 64 % max(1, size[0] - 64), 0))
+        path = os.path.join(directory, f'photo_{i}{ext}')
+        photo.save(path, image_format)
+        images.append(path)
+    return images
+
+
+# 基准测试套件的合成图片格式：名称 -> (扩展名, Pillow格式名)
+SUITE_FORMATS = {
+    'png': ('.png', 'PNG'),
+    'jpeg': ('.jpg', 'JPEG'),
+    'gif': ('.gif', 'GIF'),
+    'bmp': ('.bmp', 'BMP'),
+}
+
+
+# 由样本图片生成指定格式和分辨率的合成图片：先生成variants个像素内容不同的变体，
+# 再按make_corpus的方式循环复制并追加序号，得到count个内容互不相同的文件
+def make_synthetic_corpus(directory, count, image_format, size, variants=16):
+    from PIL import Image
+
+    extension, pil_format = SUITE_FORMATS[image_format]
+    seed_dir = os.path.join(directory, 'seeds')
+    os.makedirs(seed_dir, exist_ok=True)
+    seeds = []
+    for i in range(variants):
+        with Image.open(SEED_IMAGES[i % len(SEED_IMAGES)]) as seed:
+            image = seed.convert('RGB').resize(size)
+        block = Image.new('RGB', (max(1, size[0] // 4), max(1, size[1] // 4)),
+                          (i * 37 % 256, i * 91 % 256, i * 53 % 256))
+        image.paste(block, (i * size[0] // variants, i * size[1] // variants))
+        path = os.path.join(seed_dir, f'seed_{i}{extension}')
+        image.save(path, pil_format)
+        seeds.append(path)
+    return make_corpus(directory, count, seeds)
+
+
+# 对N张图片跑一次完整的 复制成员 -> 写入图片 -> 修改XML -> 写入部件 流程，
+# 返回 (耗时秒数, 输出文件字节数)；inspect用于在输出文件删除前检查它，结果追加在返回值末尾
+def run_build(count, seed_images=SEED_IMAGES, profile=wps.DEFAULT_PROFILE,
+              workers=wps.DEFAULT_WORKERS, use_processes=False, transform=None,
+              images=None, inspect=None, cache=None):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        if images is None:
+            images = make_corpus(temp_dir, count, seed_images)
+        output_excel = os.path.join(temp_dir, 'output.xlsx')
+
+        start = time.perf_counter()
+        wps.embed_images(output_excel, grid_mapping(images), profile=profile, workers=workers,
+                         use_processes=use_processes, transform=transform, cache=cache)
+        elapsed = time.perf_counter() - start
+        if inspect is not None:
+            return elapsed, os.path.getsize(output_excel), inspect(output_excel)
+        return elapsed, os.path.getsize(output_excel)
+
+
+# 打开耗时的代理指标：解码输出包中全部图片的耗时和总像素数
+def measure_open_cost(output_excel):
+    from PIL import Image
+
+    pixels = 0
+    start = time.perf_counter()
+    with zipfile.ZipFile(output_excel) as zip_ref:
+        for name in zip_ref.namelist():
+            if name.startswith('xl/media/'):
+                with Image.open(io.BytesIO(zip_ref.read(name))) as img:
+                    img.load()
+                    pixels += img.width * img.height
+    return time.perf_counter() - start, pixels
+
+
+# 基准测试只需要最终结果，屏蔽逐步打印
+def quiet(func, *args, **kwargs):
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return func(*args, **kwargs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def parse_sizes(value):
+    return [int(s) for s in value.split(',')]
+
+
+# 线性扩展测试
+def bench_scaling(args):
+    results = []
+    for count in args.sizes:
+        elapsed, _ = quiet(run_build, count, workers=args.workers,
+                           use_processes=args.processes)
+        results.append((count, elapsed))
+        print(f"{count:>8} 张图片: {elapsed:8.2f} 秒, "
+              f"{elapsed / count * 1000:6.3f} 毫秒/张, {count / elapsed:8.1f} 张/秒")
+
+    # 线性扩展时，每张图片的耗时应基本保持不变
+    first_count, first_elapsed = results[0]
+    for count, elapsed in results[1:]:
+        ratio = (elapsed / count) / (first_elapsed / first_count)
+        print(f"{count} 张相对 {first_count} 张的单张耗时比: {ratio:.2f}")
+
+
+# 各输出配置的耗时和文件大小对比（使用img/目录下的全部图片循环放大）
+def bench_compression(args):
+    print(f"样本图片: {len(BUNDLED_IMAGES)} 张, 放大到 {args.count} 张")
+    for profile in wps.OUTPUT_PROFILES:
+        elapsed, size = quiet(run_build, args.count, BUNDLED_IMAGES, profile)
+        print(f"{profile:>6}: {elapsed:8.2f} 秒, 输出 {size / 1024 / 1024:8.2f} MB")
+
+
+# 缩放/重新编码前后的输出大小和打开耗时代理指标对比
+def bench_transform(args):
+    transforms = [
+        ('原图', None),
+        ('缩放到单元格', wps.fit_to_cell_transform()),
+        ('缩放+JPEG', wps.fit_to_cell_transform(convert_to='jpeg')),
+        ('缩放+WebP', wps.fit_to_cell_transform(convert_to='webp')),
+    ]
+    with tempfile.TemporaryDirectory() as corpus_dir:
+        images = make_photo_corpus(corpus_dir, args.count, (args.width, args.height))
+        print(f"{args.count} 张 {args.width}x{args.height} 照片")
+        for label, transform in transforms:
+            elapsed, size, (decode_time, pixels) = quiet(
+                run_build, args.count, workers=args.workers, use_processes=args.processes,
+                transform=transform, images=images, inspect=measure_open_cost
+            )
+            print(f"{label:>8}: 生成 {elapsed:7.2f} 秒, 输出 {size / 1024 / 1024:8.2f} MB, "
+                  f"解码图片 {decode_time:6.2f} 秒, 共 {pixels / 1e6:8.1f} 百万像素")
+
+
+# 冷缓存和热缓存下的生成耗时对比
+def bench_cache(args):
+    transform = wps.fit_to_cell_transform(convert_to='jpeg')
+    with tempfile.TemporaryDirectory() as corpus_dir, \
+            tempfile.TemporaryDirectory() as cache_dir:
+        images = make_photo_corpus(corpus_dir, args.count, (args.width, args.height))
+        print(f"{args.count} 张 {args.width}x{args.height} 照片，缩放+JPEG")
+        for label in ('冷缓存', '热缓存'):
+            cache = wps.ImageCache(cache_dir)
+            elapsed, _ = quiet(run_build, args.count, workers=args.workers,
+                               transform=transform, images=images, cache=cache)
+            print(f"{label}: {elapsed:7.2f} 秒, {cache.summary()}")
+
+
+# 追加测试：先生成包含base_count张图片的工作簿，再追加count张图片，
+# 与把全部图片重新生成一遍的耗时对比
+def bench_append(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        images = make_corpus(temp_dir, args.base_count + args.count, SEED_IMAGES)
+        base_images, new_images = images[:args.base_count], images[args.base_count:]
+        workbook = os.path.join(temp_dir, 'base.xlsx')
+        quiet(wps.embed_images, workbook, grid_mapping(base_images))
+        print(f"已有工作簿: {args.base_count} 张图片, {os.path.getsize(workbook) / 1024 / 1024:.2f} MB")
+
+        # 追加的图片放在已有网格下方的空行中
+        first_row = args.base_count // 100 + 1
+        mapping = [
+            (None, wps.rowcol_to_cell(first_row + i // 100, i % 100), image)
+            for i, image in enumerate(new_images)
+        ]
+        start = time.perf_counter()
+        quiet(wps.append_images, workbook, mapping, os.path.join(temp_dir, 'appended.xlsx'))
+        append_elapsed = time.perf_counter() - start
+
+        rebuild_elapsed, _ = quiet(run_build, len(images), images=images)
+        print(f"追加 {args.count} 张: {append_elapsed:7.2f} 秒; "
+              f"重新生成全部 {len(images)} 张: {rebuild_elapsed:7.2f} 秒")
+
+
+# 分片输出测试：同样的图片写成一个文件，与按per_file分片并行生成的耗时对比
+def bench_shard(args):
+    with tempfile.TemporaryDirectory() as temp_dir:
+        images = make_corpus(temp_dir, args.count, SEED_IMAGES)
+        output = os.path.join(temp_dir, 'output.xlsx')
+
+        start = time.perf_counter()
+        quiet(wps.embed_images, output, grid_mapping(images))
+        single_elapsed = time.perf_counter() - start
+        print(f"单个文件: {single_elapsed:7.2f} 秒")
+
+        start = time.perf_counter()
+        results = quiet(wps.embed_images_sharded, output, images, per_sheet=args.per_sheet,
+                        per_file=args.per_file, per_row=100, processes=args.processes)
+        elapsed = time.perf_counter() - start
+        print(f"{len(results)} 个分片（每个文件 {args.per_file} 张，{args.processes or os.cpu_count()} 个进程）: "
+              f"{elapsed:7.2f} 秒, 加速比 {single_elapsed / elapsed:.2f}")
+
+
+# 服务测试：每次导出启动一个子进程，与向常驻服务发送请求的耗时对比
+def bench_service(args):
+    import asyncio
+    import subprocess
+    import wps_embed_service as service
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    script = os.path.join(repo_dir, 'insert_images_wps_embedded.py')
+    with tempfile.TemporaryDirectory() as temp_dir:
+        images = make_corpus(temp_dir, args.count, SEED_IMAGES)
+        names = [os.path.basename(path) for path in images]
+
+        start = time.perf_counter()
+        for i in range(args.requests):
+            subprocess.run(
+                [sys.executable, script, *images, '-o', os.path.join(temp_dir, f'sub_{i}.xlsx')],
+                check=True, capture_output=True
+            )
+        subprocess_elapsed = time.perf_counter() - start
+        print(f"子进程 ({args.requests} 次导出): {subprocess_elapsed:7.2f} 秒, "
+              f"每次 {subprocess_elapsed / args.requests * 1000:.1f} 毫秒")
+
+        async def run():
+            embed_service = service.EmbedService(temp_dir, max_concurrent=args.concurrency,
+                                                 max_queue=args.requests)
+            server = await asyncio.start_server(embed_service.handle, '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            try:
+                start = time.perf_counter()
+                await asyncio.gather(*[
+                    service.request_workbook(os.path.join(temp_dir, f'svc_{i}.xlsx'), names,
+                                             port=port)
+                    for i in range(args.requests)
+                ])
+                return time.perf_counter() - start
+            finally:
+                server.close()
+                await server.wait_closed()
+                embed_service.close()
+
+        service_elapsed = quiet(asyncio.run, run())
+        print(f"服务   ({args.requests} 次请求, 并发 {args.concurrency}): {service_elapsed:7.2f} 秒, "
+              f"每次 {service_elapsed / args.requests * 1000:.1f} 毫秒, "
+              f"加速比 {subprocess_elapsed / service_elapsed:.2f}")
+
+
+# 逐个构造lxml元素生成cellImage和图片关系（模板生成之前的实现），作为对比基准
+def build_cell_images_lxml(count):
+    from lxml import etree
+
+    ns_xdr, ns_a = wps.NS_XDR, wps.NS_A
+    cellimages = etree.Element(
+        f'{{{wps.NS_ETC}}}cellImages',
+        nsmap={'xdr': wps.NS_XDR, 'r': wps.NS_R, 'a': wps.NS_A, 'etc': wps.NS_ETC}
+    )
+    rels = etree.Element(f'{{{wps.NS_REL}}}Relationships', nsmap={None: wps.NS_REL})
+    for i in range(count):
+        image_id, r_id = f'ID_{i:032x}', f'rId{i + 1}'
+        cell_image = etree.SubElement(cellimages, f'{{{wps.NS_ETC}}}cellImage')
+        pic = etree.SubElement(cell_image, f'{{{ns_xdr}}}pic')
+        nv_pic_pr = etree.SubElement(pic, f'{{{ns_xdr}}}nvPicPr')
+        etree.SubElement(nv_pic_pr, f'{{{ns_xdr}}}cNvPr', id=str(i + 2), name=image_id)
+        c_nv_pic_pr = etree.SubElement(nv_pic_pr, f'{{{ns_xdr}}}cNvPicPr')
+        etree.SubElement(c_nv_pic_pr, f'{{{ns_a}}}picLocks', noChangeAspect='1')
+        blip_fill = etree.SubElement(pic, f'{{{ns_xdr}}}blipFill')
+        etree.SubElement(blip_fill, f'{{{ns_a}}}blip', **{f'{{{wps.NS_R}}}embed': r_id})
+        stretch = etree.SubElement(blip_fill, f'{{{ns_a}}}stretch')
+        etree.SubElement(stretch, f'{{{ns_a}}}fillRect')
+        sp_pr = etree.SubElement(pic, f'{{{ns_xdr}}}spPr')
+        xfrm = etree.SubElement(sp_pr, f'{{{ns_a}}}xfrm')
+        etree.SubElement(xfrm, f'{{{ns_a}}}off', x='0', y='0')
+        etree.SubElement(xfrm, f'{{{ns_a}}}ext', cx=str(1905000 + i), cy='1428750')
+        prst_geom = etree.SubElement(sp_pr, f'{{{ns_a}}}prstGeom', prst='rect')
+        etree.SubElement(prst_geom, f'{{{ns_a}}}avLst')
+        etree.SubElement(sp_pr, f'{{{ns_a}}}noFill')
+        ln = etree.SubElement(sp_pr, f'{{{ns_a}}}ln', w='9525')
+        etree.SubElement(ln, f'{{{ns_a}}}noFill')
+        etree.SubElement(rels, f'{{{wps.NS_REL}}}Relationship', Id=r_id,
+                         Type=wps.REL_TYPE_IMAGE, Target=f'media/image_{i}.png')
+
+    parts = []
+    for root in (cellimages, rels):
+        output = io.BytesIO()
+        etree.ElementTree(root).write(output, pretty_print=True, xml_declaration=True,
+                                      encoding='UTF-8')
+        parts.append(output.getvalue())
+    return parts
+
+
+# 按模板生成同样的片段，写入空的cellimages.xml和关系部件
+def build_cell_images_template(count):
+    from lxml import etree
+
+    cellimages = etree.ElementTree(etree.Element(
+        f'{{{wps.NS_ETC}}}cellImages',
+        nsmap={'xdr': wps.NS_XDR, 'r': wps.NS_R, 'a': wps.NS_A, 'etc': wps.NS_ETC}
+    ))
+    rels = etree.ElementTree(etree.Element(f'{{{wps.NS_REL}}}Relationships',
+                                           nsmap={None: wps.NS_REL}))
+    cell_image_fragments = []
+    rel_fragments = []
+    for i in range(count):
+        image_id, r_id = f'ID_{i:032x}', f'rId{i + 1}'
+        cell_image_fragments.append(wps.CELL_IMAGE_TEMPLATE % (
+            i + 2, wps.escape_attribute(image_id), wps.escape_attribute(r_id), 1905000 + i, 1428750
+        ))
+        rel_fragments.append(wps.IMAGE_REL_TEMPLATE % (
+            wps.escape_attribute(r_id), wps.escape_attribute(f'image_{i}.png')
+        ))
+
+    parts = []
+    for tree, fragments in ((cellimages, cell_image_fragments), (rels, rel_fragments)):
+        output = io.BytesIO()
+        wps.write_with_fragments(output, tree, fragments)
+        parts.append(output.getvalue())
+    return parts
+
+
+# 忽略缩进后的规范化XML，用于确认两种生成方式的结果相同
+def canonical_xml(data):
+    from lxml import etree
+
+    parser = etree.XMLParser(remove_blank_text=True)
+    return etree.tostring(etree.fromstring(data, parser), method='c14n')
+
+
+# cellImage片段生成的微基准：逐个构造lxml元素与按模板格式化的耗时对比（包含序列化）
+def bench_fragments(args):
+    reference = build_cell_images_lxml(min(args.count, 100))
+    generated = build_cell_images_template(min(args.count, 100))
+    if list(map(canonical_xml, reference)) != list(map(canonical_xml, generated)):
+        print("❌ 模板生成的XML与lxml构造的结果不一致")
+        sys.exit(1)
+
+    timings = {}
+    for label, build in (('lxml逐个构造', build_cell_images_lxml), ('模板片段', build_cell_images_template)):
+        best = float('inf')
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            build(args.count)
+            best = min(best, time.perf_counter() - start)
+        timings[label] = best
+        print(f"{label}: {best:7.3f} 秒, {best / args.count * 1e6:6.2f} 微秒/张")
+    lxml_time, template_time = timings.values()
+    print(f"{args.count} 张图片, 加速比 {lxml_time / template_time:.1f}")
+
+
+# 用新的解释器运行一次完整的命令行流程（与用户运行脚本的路径相同），
+# 返回 (总耗时秒数, 输出文件字节数, 统计报告)
+def run_main(images, temp_dir, extra_args=()):
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'insert_images_wps_embedded.py')
+    image_list = os.path.join(temp_dir, 'images.txt')
+    with open(image_list, 'w', encoding='utf-8') as f:
+        f.writelines(f'{path}\n' for path in images)
+    output = os.path.join(temp_dir, 'output.xlsx')
+    report_path = os.path.join(temp_dir, 'report.json')
+
+    import json
+    import subprocess
+
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, script, '-m', image_list, '-o', output, '--per-row', '100', '-q',
+         '--report', report_path, *extra_args],
+        check=True, capture_output=True
+    )
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(output)
+    with open(report_path, encoding='utf-8') as f:
+        report = json.load(f)
+    os.remove(output)
+    return elapsed, size, report
+
+
+# 按显示宽度（汉字占两列）补齐表头，width为负数时左对齐
+def pad(text, width):
+    import unicodedata
+
+    display = sum(2 if unicodedata.east_asian_width(c) in 'WF' else 1 for c in text)
+    fill = ' ' * max(0, abs(width) - display)
+    return text + fill if width < 0 else fill + text
+
+
+def parse_resolution(value):
+    width, height = value.lower().split('x')
+    return int(width), int(height)
+
+
+# 基准测试套件：按格式生成合成图片，在每个规模下运行完整的命令行流程，
+# 记录总耗时、流水线耗时、吞吐量、输出大小、峰值内存和各阶段耗时。
+# --save把结果写成JSON，--baseline与之前保存的结果对比，
+# 单张耗时或峰值内存超出容差时以非0状态退出，用于发现性能回退
+def bench_suite(args):
+    import json
+
+    extra = args.extra[1:] if args.extra[:1] == ['--'] else args.extra
+    results = []
+    print(pad('格式', -6) + pad('数量', 8) + pad('总耗时(秒)', 12) + pad('流水线(秒)', 12)
+          + pad('张/秒', 10) + pad('毫秒/张', 9) + pad('输出(MB)', 10) + pad('峰值RSS(MB)', 13)
+          + '  最慢阶段')
+    for image_format in args.formats:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            corpus = make_synthetic_corpus(temp_dir, max(args.sizes), image_format, args.resolution)
+            for count in args.sizes:
+                runs = [run_main(corpus[:count], temp_dir, extra) for _ in range(args.repeat)]
+                # 取流水线耗时的中位数那一次
+                runs.sort(key=lambda run: run[2]['elapsed'])
+                elapsed, size, report = runs[len(runs) // 2]
+                pipeline = report['elapsed']
+                stages = {name: stage['seconds'] for name, stage in report['stages'].items()}
+                slowest = max(stages, key=stages.get)
+                result = {
+                    'format': image_format, 'count': count,
+                    'resolution': '{}x{}'.format(*args.resolution),
+                    'wall_seconds': elapsed, 'pipeline_seconds': pipeline,
+                    'images_per_second': count / pipeline, 'ms_per_image': pipeline / count * 1000,
+                    'output_bytes': size, 'peak_rss': report['peak_rss'], 'stages': stages,
+                }
+                results.append(result)
+                print(f"{image_format:<6}{count:>8}{elapsed:>12.2f}{pipeline:>12.2f}"
+                      f"{result['images_per_second']:>10.1f}{result['ms_per_image']:>9.3f}"
+                      f"{size / 1024 ** 2:>10.2f}{(report['peak_rss'] or 0) / 1024 ** 2:>13.1f}"
+                      f"  {slowest} {stages[slowest]:.2f}秒")
+
+    # 线性扩展时单张耗时基本不变；规模很小时启动开销占比大，比值会偏高
+    print()
+    for image_format in args.formats:
+        rows = [r for r in results if r['format'] == image_format]
+        ratios = ', '.join(
+            f"{r['count']}: {r['ms_per_image'] / rows[0]['ms_per_image']:.2f}" for r in rows[1:]
+        )
+        if ratios:
+            print(f"{image_format} 相对 {rows[0]['count']} 张的单张耗时比: {ratios}")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"结果已保存: {args.save}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = {(r['format'], r['count'], r['resolution']): r for r in json.load(f)}
+        regressions = []
+        for result in results:
+            old = baseline.get((result['format'], result['count'], result['resolution']))
+            if old is None:
+                continue
+            for key in ('ms_per_image', 'peak_rss'):
+                if old[key] and result[key] and result[key] > old[key] * (1 + args.tolerance):
+                    regressions.append(
+                        f"{result['format']} {result['count']} 张: {key} "
+                        f"{old[key]:.3f} -> {result[key]:.3f} ({result[key] / old[key]:.2f}倍)"
+                    )
+        print(f"与基线 {args.baseline} 对比（容差 {args.tolerance:.0%}）:")
+        for line in regressions:
+            print(f"❌ {line}")
+        if regressions:
+            sys.exit(1)
+        print("✅ 没有发现性能回退")
+
+
+# import时不应加载的重量级依赖
+HEAVY_MODULES = ('PIL', 'lxml', 'xlsxwriter', 'concurrent.futures')
+
+IMPORT_PROBE = '''
+import sys, time, json
+start = time.perf_counter()
+import insert_images_wps_embedded
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'modules': [m for m in sys.argv[1:] if m in sys.modules]}))
+'''
+
+
+# import耗时测试：在空的临时目录中用新的解释器反复导入，
+# 同时检查没有加载重量级依赖、没有在当前目录创建文件
+def bench_import(args):
+    import json
+    import statistics
+    import subprocess
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    timings = []
+    loaded = set()
+    with tempfile.TemporaryDirectory() as cwd:
+        for _ in range(args.repeat):
+            output = subprocess.run(
+                [sys.executable, '-c', IMPORT_PROBE, *HEAVY_MODULES],
+                cwd=cwd, env=env, check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            timings.append(result['elapsed'] * 1000)
+            loaded.update(result['modules'])
+        created = os.listdir(cwd)
+
+    median = statistics.median(timings)
+    print(f"import耗时: 中位数 {median:.1f} 毫秒, 最小 {min(timings):.1f} 毫秒 ({args.repeat} 次)")
+    failed = False
+    if loaded:
+        print(f"❌ import时加载了重量级依赖: {', '.join(sorted(loaded))}")
+        failed = True
+    if created:
+        print(f"❌ import时在当前目录创建了文件: {', '.join(created)}")
+        failed = True
+    if args.max_ms and median > args.max_ms:
+        print(f"❌ import耗时超过上限 {args.max_ms} 毫秒")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+PREPARE_PROBE = '''
+import sys, json
+import insert_images_wps_embedded as wps
+path, in_memory = sys.argv[1], sys.argv[2] == '1'
+if in_memory:
+    with open(path, 'rb') as f:
+        source = f.read()
+else:
+    source = path
+try:
+    prepared = wps.prepare_image(source)
+    result = {'size': [prepared.width, prepared.height], 'extension': prepared.extension}
+except Exception as e:
+    result = {'error': type(e).__name__}
+print(json.dumps(result))
+'''
+
+# 损坏或无法识别的图片应该得到的错误（带有图片源名称的ImageError，而不是AttributeError等接口错误）
+EXPECTED_IMAGE_ERRORS = ('ImageError',)
+
+
+# 图片格式探测检查：每种格式和损坏的文件头分别以文件路径和内存数据两种方式，
+# 在新的解释器中准备一次（Pillow的插件此时还没有初始化，回退到逐个尝试插件的路径），
+# 检查尺寸和扩展名，损坏的数据只允许得到格式错误
+def bench_probe(args):
+    import json
+    import subprocess
+    from PIL import Image
+
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=repo_dir)
+    cases = [
+        ('png', 'PNG', (41, 23), '.png'),
+        ('jpeg', 'JPEG', (42, 24), '.jpg'),
+        ('gif', 'GIF', (43, 25), '.gif'),
+        ('bmp', 'BMP', (44, 26), '.bmp'),
+        ('webp', 'WEBP', (45, 27), '.webp'),
+        ('tiff', 'TIFF', (46, 28), '.tiff'),
+    ]
+    corrupt = [
+        ('截断的PNG', b'\x89PNG\r\n\x1a\n\x00\x00'),
+        ('随机数据', b'not an image at all'),
+        ('空文件', b''),
+    ]
+    failed = False
+    with tempfile.TemporaryDirectory() as temp_dir:
+        checks = []
+        for name, image_format, size, extension in cases:
+            path = os.path.join(temp_dir, f'sample{extension}')
+            Image.new('RGB', size, 'red').save(path, image_format)
+            checks.append((name, path, {'size': list(size), 'extension': extension}))
+        for i, (name, data) in enumerate(corrupt):
+            path = os.path.join(temp_dir, f'corrupt{i}.png')
+            with open(path, 'wb') as f:
+                f.write(data)
+            checks.append((name, path, None))
+
+        for name, path, expected in checks:
+            for in_memory in (False, True):
+                output = subprocess.run(
+                    [sys.executable, '-c', PREPARE_PROBE, path, '1' if in_memory else '0'],
+                    cwd=temp_dir, env=env, check=True, capture_output=True, text=True
+                ).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                ok = result == expected if expected else result.get('error') in EXPECTED_IMAGE_ERRORS
+                failed = failed or not ok
+                print(f"{'✅' if ok else '❌'} {pad(name, -12)} {'内存' if in_memory else '路径'}  {result}")
+    if failed:
+        sys.exit(1)
+
+
+# 检查点和--skip-errors的退出状态检查：一批图片中有一张损坏，
+# 不加--skip-errors时中止（状态1、不留输出、保留检查点），加--skip-errors时生成文件并以EXIT_SKIPPED退出，
+# 修复图片后用相同的检查点重新运行时以0退出，并沿用检查点中的图片
+def bench_checkpoint(args):
+    import json
+    import shutil
+    import subprocess
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'insert_images_wps_embedded.py')
+    failed = False
+
+    def check(name, ok, detail=''):
+        nonlocal failed
+        failed = failed or not ok
+        print(f"{'✅' if ok else '❌'} {name} {detail}")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        images = make_corpus(temp_dir, args.count, SEED_IMAGES)
+        bad = images[len(images) // 2]
+        shutil.copy(bad, f'{bad}.orig')
+        with open(bad, 'wb') as f:
+            f.write(b'not an image')
+        output = os.path.join(temp_dir, 'output.xlsx')
+        checkpoint = os.path.join(temp_dir, 'checkpoint')
+        report_path = os.path.join(temp_dir, 'report.json')
+
+        def run(*extra_args):
+            return subprocess.run(
+                [sys.executable, script, *images, '-o', output, '-q', '--report', report_path,
+                 *extra_args],
+                capture_output=True
+            ).returncode
+
+        status = run('--checkpoint', checkpoint)
+        check('损坏的图片中止构建', status == 1 and not os.path.exists(output), f'(状态 {status})')
+        check('中止后保留检查点', os.path.exists(os.path.join(checkpoint, 'journal.jsonl')))
+
+        status = run('--skip-errors')
+        check('--skip-errors跳过并以非0状态退出', status == wps.EXIT_SKIPPED and os.path.exists(output),
+              f'(状态 {status})')
+        os.remove(output)
+
+        shutil.copy(f'{bad}.orig', bad)
+        status = run('--checkpoint', checkpoint)
+        with open(report_path, encoding='utf-8') as f:
+            resumed = json.load(f).get('checkpoint', {}).get('resumed', 0)
+        check('修复后从检查点继续', status == 0 and resumed > 0, f'(状态 {status}，沿用 {resumed} 张)')
+        check('成功后删除检查点', not os.path.exists(checkpoint))
+    if failed:
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='WPS内嵌图片性能基准测试')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    scaling = subparsers.add_parser('scaling', help='图片数量的线性扩展测试')
+    scaling.add_argument('--sizes', type=parse_sizes, default='100,1000,10000,50000',
+                         help='逗号分隔的图片数量列表')
+    scaling.add_argument('--workers', type=int, default=wps.DEFAULT_WORKERS,
+                         help='图片准备阶段的并发数')
+    scaling.add_argument('--processes', action='store_true',
+                         help='使用进程池而不是线程池')
+    scaling.set_defaults(func=bench_scaling)
+
+    compression = subparsers.add_parser('compression', help='各输出配置的耗时和文件大小')
+    compression.add_argument('--count', type=int, default=5000, help='图片数量')
+    compression.set_defaults(func=bench_compression)
+
+    transform = subparsers.add_parser('transform', help='缩放/重新编码前后的输出大小对比')
+    transform.add_argument('--count', type=int, default=20, help='照片数量')
+    transform.add_argument('--width', type=int, default=4000, help='照片宽度')
+    transform.add_argument('--height', type=int, default=3000, help='照片高度')
+    transform.add_argument('--workers', type=int, default=wps.DEFAULT_WORKERS,
+                           help='图片准备阶段的并发数')
+    transform.add_argument('--processes', action='store_true',
+                           help='使用进程池而不是线程池')
+    transform.set_defaults(func=bench_transform)
+
+    cache = subparsers.add_parser('cache', help='冷缓存和热缓存的生成耗时对比')
+    cache.add_argument('--count', type=int, default=20, help='照片数量')
+    cache.add_argument('--width', type=int, default=4000, help='照片宽度')
+    cache.add_argument('--height', type=int, default=3000, help='照片高度')
+    cache.add_argument('--workers', type=int, default=wps.DEFAULT_WORKERS,
+                       help='图片准备阶段的并发数')
+    cache.set_defaults(func=bench_cache)
+
+    append = subparsers.add_parser('append', help='追加到已有工作簿与重新生成的耗时对比')
+    append.add_argument('--base-count', type=int, default=20000, help='已有工作簿中的图片数量')
+    append.add_argument('--count', type=int, default=200, help='追加的图片数量')
+    append.set_defaults(func=bench_append)
+
+    shard = subparsers.add_parser('shard', help='单个文件与分片并行输出的耗时对比')
+    shard.add_argument('--count', type=int, default=50000, help='图片数量')
+    shard.add_argument('--per-file', type=int, default=10000, help='每个文件的图片数量上限')
+    shard.add_argument('--per-sheet', type=int, default=0, help='每个工作表的图片数量上限')
+    shard.add_argument('--processes', type=int, default=0, help='进程数，默认为CPU核数')
+    shard.set_defaults(func=bench_shard)
+
+    service = subparsers.add_parser('service', help='每次导出一个子进程与常驻服务的耗时对比')
+    service.add_argument('--count', type=int, default=20, help='每次导出的图片数量')
+    service.add_argument('--requests', type=int, default=20, help='导出次数')
+    service.add_argument('--concurrency', type=int, default=2, help='服务同时生成的工作簿数')
+    service.set_defaults(func=bench_service)
+
+    fragments = subparsers.add_parser('fragments', help='cellImage片段生成的微基准')
+    fragments.add_argument('--count', type=int, default=50000, help='图片数量')
+    fragments.add_argument('--repeat', type=int, default=3, help='重复次数，取最快的一次')
+    fragments.set_defaults(func=bench_fragments)
+
+    suite = subparsers.add_parser('suite', help='合成图片的完整流程基准测试套件')
+    suite.add_argument('--sizes', type=parse_sizes, default='10,100,1000,10000,50000',
+                       help='逗号分隔的图片数量列表')
+    suite.add_argument('--formats', type=lambda value: value.split(','),
+                       default=list(SUITE_FORMATS), help='逗号分隔的图片格式（png,jpeg,gif,bmp）')
+    suite.add_argument('--resolution', type=parse_resolution, default='200x200',
+                       help='合成图片的分辨率，例如200x200')
+    suite.add_argument('--repeat', type=int, default=1, help='每个规模的重复次数，取中位数')
+    suite.add_argument('--save', metavar='FILE', help='把结果保存为JSON')
+    suite.add_argument('--baseline', metavar='FILE', help='与之前保存的结果对比')
+    suite.add_argument('--tolerance', type=float, default=0.25,
+                       help='允许的单张耗时和峰值内存增幅（0.25表示25%%）')
+    suite.add_argument('extra', nargs=argparse.REMAINDER,
+                       help='传给主脚本的其他参数，例如 -- --profile small --workers 8')
+    suite.set_defaults(func=bench_suite)
+
+    import_time = subparsers.add_parser('import', help='模块import耗时和副作用检查')
+    import_time.add_argument('--repeat', type=int, default=10, help='重复次数')
+    import_time.add_argument('--max-ms', type=float, default=0,
+                             help='import耗时中位数上限（毫秒），超过时以非0状态退出')
+    import_time.set_defaults(func=bench_import)
+
+    probe = subparsers.add_parser('probe', help='各图片格式和损坏文件头的探测检查（新的解释器中）')
+    probe.set_defaults(func=bench_probe)
+
+    checkpoint = subparsers.add_parser('checkpoint', help='检查点恢复和--skip-errors退出状态的检查')
+    checkpoint.add_argument('--count', type=int, default=200, help='图片数量')
+    checkpoint.set_defaults(func=bench_checkpoint)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,92 +1,330 @@
-import zipfile
-import tempfile
-import os
+import re
 import sys
-import lxml.etree as etree
+import json
+import time
+import zipfile
+import argparse
+import posixpath
+
+import insert_images_wps_embedded as wps
+
+# 工作表XML按块扫描的大小，以及块之间保留的重叠长度（大于任何一个匹配的长度）
+SCAN_CHUNK_SIZE = 1024 * 1024
+SCAN_OVERLAP = 4096
+
+# DISPIMG公式中的图片ID，引号可能是原样的"也可能是&quot;
+DISPIMG_PATTERN = re.compile(rb'DISPIMG\((?:"|&quot;)([^"&<]*)(?:"|&quot;)')
+# 单元格开始标签中的r属性
+CELL_REF_PATTERN = re.compile(rb'<(?:[\w.-]+:)?c\s[^>]*?\br="([A-Za-z]+[0-9]+)"')
+
+
+# 每类问题最多列出的条数
+MAX_LISTED = 20
+
+
+# 关系目标 -> 包内部件名（相对路径相对于源部件所在目录）
+def resolve_target(source_part, target):
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join(posixpath.dirname(source_part), target))
+
+
+# 部件对应的关系部件名：xl/cellimages.xml -> xl/_rels/cellimages.xml.rels
+def rels_part(part_name):
+    directory, name = posixpath.split(part_name)
+    return posixpath.join(directory, '_rels', f'{name}.rels')
+
+
+# 检查结果：错误、警告和统计，问题按类别计数，每类只保留前MAX_LISTED条
+class Findings:
+    def __init__(self):
+        self.errors = {}
+        self.warnings = {}
+        self.stats = {}
+
+    def _add(self, bucket, kind, detail):
+        entry = bucket.setdefault(kind, {'count': 0, 'examples': []})
+        entry['count'] += 1
+        if len(entry['examples']) < MAX_LISTED:
+            entry['examples'].append(detail)
+
+    def error(self, kind, detail):
+        self._add(self.errors, kind, detail)
+
+    def warning(self, kind, detail):
+        self._add(self.warnings, kind, detail)
+
+
+# 读取一个关系部件，返回 [(Id, Type, 目标部件名或None（外部链接）)]
+def read_rels(zip_ref, part_name):
+    try:
+        data = zip_ref.read(rels_part(part_name))
+    except KeyError:
+        return []
+    rels = []
+    for rel in wps.etree.fromstring(data).iter(f'{{{wps.NS_REL}}}Relationship'):
+        target = rel.get('Target', '')
+        external = rel.get('TargetMode') == 'External'
+        rels.append((rel.get('Id'), rel.get('Type'), None if external else resolve_target(part_name, target)))
+    return rels
+
+
+# 流式扫描工作表XML，对每个引用了图片的单元格调用一次on_reference(单元格地址, 图片ID)，
+# 返回图片单元格数。只搜索DISPIMG，找到后再向前定位所在单元格的开始标签，
+# 普通单元格不需要逐个匹配；同一个单元格的公式和缓存值中的ID只计一次
+def scan_sheet(zip_ref, part_name, on_reference):
+    references = 0
+    buffer = b''
+    offset = 0
+    processed = 0
+    last_cell_start = -1
+    with zip_ref.open(part_name) as f:
+        eof = False
+        while not eof:
+            chunk = f.read(SCAN_CHUNK_SIZE)
+            eof = not chunk
+            buffer += chunk
+            # 末尾SCAN_OVERLAP字节内的匹配可能被块边界截断，留到下一块再处理
+            limit = len(buffer) if eof else len(buffer) - SCAN_OVERLAP
+            for match in DISPIMG_PATTERN.finditer(buffer, max(0, processed - offset)):
+                if match.end() > limit:
+                    break
+                processed = offset + match.end()
+                # 单元格元素不会比SCAN_OVERLAP长，只在这个范围内向前查找
+                window = max(0, match.start() - SCAN_OVERLAP)
+                cell_start = max(buffer.rfind(b'<c ', window, match.start()),
+                                 buffer.rfind(b':c ', window, match.start()))
+                if cell_start >= 0 and offset + cell_start == last_cell_start:
+                    continue
+                last_cell_start = offset + cell_start if cell_start >= 0 else -1
+                cell_ref = CELL_REF_PATTERN.match(buffer, buffer.rfind(b'<', 0, cell_start + 1)) \
+                    if cell_start >= 0 else None
+                references += 1
+                on_reference(cell_ref.group(1).decode('ascii') if cell_ref else None,
+                             match.group(1).decode('utf-8', 'replace'))
+            # 保留末尾一段：其中可能有被截断的匹配，以及下一个匹配所在单元格的开始标签
+            keep = max(0, len(buffer) - 2 * SCAN_OVERLAP)
+            buffer = buffer[keep:]
+            offset += keep
+    return references
 
+
+# 检查WPS内嵌图片工作簿的结构，只读取元数据部件（XML和关系），图片成员只看ZIP目录中的大小，
+# 不解压整个包，耗时与元数据大小成正比。检查：
+#   工作表中每个DISPIMG图片ID都能在cellimages.xml中找到对应的cellImage
+#   每个r:embed都能通过cellimages.xml.rels找到存在的media成员
+#   内容类型覆盖了所有media扩展名
+#   没有被引用的cellImage、关系和media成员（孤立项）
 def examine_excel(file_path):
-    print(f"Examining Excel file: {file_path}")
-    
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # 解压Excel文件
-        with zipfile.ZipFile(file_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-            
-        print("\n1. Checking file structure:")
-        for root, dirs, files in os.walk(temp_dir):
-            level = root.replace(temp_dir, '').count(os.sep)
-            indent = ' ' * 2 * level
-            print(f"{indent}{os.path.basename(root)}/")
-            subindent = ' ' * 2 * (level + 1)
-            for file in files:
-                print(f"{subindent}{file}")
-        
-        # 检查cellimages.xml
-        cellimages_path = os.path.join(temp_dir, 'xl', 'cellimages.xml')
-        if os.path.exists(cellimages_path):
-            print("\n2. Checking cellimages.xml:")
-            with open(cellimages_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            print(content)
-        
-        # 检查工作表XML
-        worksheet_path = os.path.join(temp_dir, 'xl', 'worksheets', 'sheet1.xml')
-        if os.path.exists(worksheet_path):
-            print("\n3. Checking sheet1.xml (B1 cell):")
-            tree = etree.parse(worksheet_path)
-            root = tree.getroot()
-            
-            # 找到sheetData和第一行
-            sheet_data = root.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheetData')
-            if sheet_data:
-                row = sheet_data.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}row')
-                if row:
-                    # 找到所有单元格
-                    cells = row.findall('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}c')
-                    if cells:
-                        # 打印特定单元格（B1, C1, D1）
-                        for cell_address in ['B1', 'C1', 'D1']:
-                            for cell in cells:
-                                if cell.get('r') == cell_address:
-                                    print(f"\nCell {cell_address}:")
-                                    # 打印单元格的XML
-                                    cell_xml = etree.tostring(cell, encoding='unicode', pretty_print=True)
-                                    print(cell_xml)
-                                    break
-        
-        # 检查Content_Types.xml
-        content_types_path = os.path.join(temp_dir, '[Content_Types].xml')
-        if os.path.exists(content_types_path):
-            print("\n4. Checking [Content_Types].xml:")
-            tree = etree.parse(content_types_path)
-            root = tree.getroot()
-            # 查看与cellimages相关的内容类型
-            for override in root.findall('{http://schemas.openxmlformats.org/package/2006/content-types}Override'):
-                if 'cellimage' in override.get('ContentType', ''):
-                    print(etree.tostring(override, encoding='unicode', pretty_print=True))
-        
-        # 检查workbook.xml.rels
-        workbook_rels_path = os.path.join(temp_dir, 'xl', '_rels', 'workbook.xml.rels')
-        if os.path.exists(workbook_rels_path):
-            print("\n5. Checking workbook.xml.rels:")
-            tree = etree.parse(workbook_rels_path)
-            root = tree.getroot()
-            # 查看与cellimage相关的关系
-            for rel in root.findall('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
-                if 'cellImage' in rel.get('Type', ''):
-                    print(etree.tostring(rel, encoding='unicode', pretty_print=True))
-        
-        # 检查cellimages.xml.rels
-        cellimages_rels_path = os.path.join(temp_dir, 'xl', '_rels', 'cellimages.xml.rels')
-        if os.path.exists(cellimages_rels_path):
-            print("\n6. Checking cellimages.xml.rels:")
-            with open(cellimages_rels_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-            print(content)
+    findings = Findings()
+    stats = findings.stats
+    start = time.perf_counter()
+
+    with zipfile.ZipFile(file_path, 'r') as zip_ref:
+        infos = zip_ref.infolist()
+        members = {info.filename: info for info in infos}
+        media = {name: info for name, info in members.items() if name.startswith('xl/media/')}
+        stats['members'] = len(infos)
+        stats['compressed_bytes'] = sum(info.compress_size for info in infos)
+        stats['uncompressed_bytes'] = sum(info.file_size for info in infos)
+        stats['media'] = len(media)
+        stats['media_bytes'] = sum(info.file_size for info in media.values())
+
+        # 内容类型
+        try:
+            content_types = wps.etree.fromstring(zip_ref.read('[Content_Types].xml'))
+        except KeyError:
+            findings.error('缺少部件', '[Content_Types].xml')
+            content_types = wps.etree.Element('Types')
+        defaults = {
+            default.get('Extension', '').lower()
+            for default in content_types.iter(f'{{{wps.NS_CT}}}Default')
+        }
+        overrides = {
+            override.get('PartName', '').lstrip('/'): override.get('ContentType')
+            for override in content_types.iter(f'{{{wps.NS_CT}}}Override')
+        }
+        uncovered = {}
+        for name in media:
+            extension = posixpath.splitext(name)[1].lstrip('.').lower()
+            if extension not in defaults and name not in overrides:
+                uncovered[extension] = uncovered.get(extension, 0) + 1
+        for extension, count in uncovered.items():
+            findings.error('内容类型未覆盖的图片扩展名', f'.{extension}（{count} 个图片成员）')
+        for part_name in overrides:
+            if part_name not in members:
+                findings.warning('内容类型中的部件不存在', part_name)
+
+        # 工作簿中的工作表和cellimages.xml
+        sheet_parts = {}
+        cellimages_part = None
+        try:
+            workbook = wps.etree.fromstring(zip_ref.read('xl/workbook.xml'))
+        except KeyError:
+            findings.error('缺少部件', 'xl/workbook.xml')
+            workbook = None
+        workbook_rels = read_rels(zip_ref, 'xl/workbook.xml')
+        targets = {r_id: target for r_id, _, target in workbook_rels}
+        if workbook is not None:
+            for sheet in workbook.iter(f'{{{wps.NS_MAIN}}}sheet'):
+                target = targets.get(sheet.get(f'{{{wps.NS_R}}}id'))
+                if target is None or target not in members:
+                    findings.error('工作表部件不存在', f"{sheet.get('name')}: {target}")
+                    continue
+                sheet_parts[sheet.get('name')] = target
+        for _, rel_type, target in workbook_rels:
+            if rel_type == wps.REL_TYPE_CELLIMAGE or (target or '').endswith('/cellimages.xml'):
+                cellimages_part = target
+        stats['sheets'] = len(sheet_parts)
+
+        if cellimages_part is None:
+            if 'xl/cellimages.xml' in members:
+                findings.error('cellimages.xml没有被workbook.xml.rels引用', 'xl/cellimages.xml')
+                cellimages_part = 'xl/cellimages.xml'
+        elif cellimages_part not in members:
+            findings.error('缺少部件', cellimages_part)
+            cellimages_part = None
+        if cellimages_part is not None and cellimages_part not in overrides:
+            findings.error('cellimages.xml没有内容类型', cellimages_part)
+
+        # cellimages.xml：逐个cellImage流式解析，解析完即释放
+        images = {}
+        shape_ids = set()
+        if cellimages_part is not None:
+            with zip_ref.open(cellimages_part) as f:
+                for _, element in wps.etree.iterparse(f, tag=f'{{{wps.NS_ETC}}}cellImage'):
+                    c_nv_pr = next(element.iter(f'{{{wps.NS_XDR}}}cNvPr'), None)
+                    blip = next(element.iter(f'{{{wps.NS_A}}}blip'), None)
+                    image_id = c_nv_pr.get('name') if c_nv_pr is not None else None
+                    r_id = blip.get(f'{{{wps.NS_R}}}embed') if blip is not None else None
+                    if not image_id:
+                        findings.error('cellImage缺少名称', f'第{len(images) + 1}个cellImage')
+                    elif image_id in images:
+                        findings.error('重复的图片ID', image_id)
+                    else:
+                        images[image_id] = r_id
+                    shape_id = c_nv_pr.get('id') if c_nv_pr is not None else None
+                    if shape_id in shape_ids:
+                        findings.warning('重复的cNvPr id', f'{image_id}: {shape_id}')
+                    shape_ids.add(shape_id)
+                    if not r_id:
+                        findings.error('cellImage缺少r:embed', image_id)
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+        stats['cell_images'] = len(images)
+
+        # r:embed -> cellimages.xml.rels -> media
+        image_rels = {}
+        if cellimages_part is not None:
+            for r_id, rel_type, target in read_rels(zip_ref, cellimages_part):
+                image_rels[r_id] = target
+                if rel_type != wps.REL_TYPE_IMAGE:
+                    findings.warning('非图片关系', f'{r_id}: {rel_type}')
+                if target is not None and target not in members:
+                    findings.error('关系指向的图片成员不存在', f'{r_id} -> {target}')
+        stats['image_relationships'] = len(image_rels)
+        embedded = set()
+        for image_id, r_id in images.items():
+            if r_id and r_id not in image_rels:
+                findings.error('r:embed在cellimages.xml.rels中不存在', f'{image_id}: {r_id}')
+            embedded.add(r_id)
+        for r_id in image_rels.keys() - embedded:
+            findings.warning('孤立的关系（没有被cellImage引用）', f'{r_id} -> {image_rels[r_id]}')
+
+        # 工作表中的DISPIMG引用
+        referenced = set()
+        cells_per_sheet = {}
+        for sheet_name, part_name in sheet_parts.items():
+            def on_reference(cell, image_id):
+                referenced.add(image_id)
+                if image_id not in images:
+                    findings.error('DISPIMG引用的图片ID不存在', f'{sheet_name}!{cell}: {image_id}')
+
+            cells_per_sheet[sheet_name] = scan_sheet(zip_ref, part_name, on_reference)
+        stats['image_cells'] = sum(cells_per_sheet.values())
+        stats['image_cells_per_sheet'] = cells_per_sheet
+        for image_id in images.keys() - referenced:
+            findings.warning('孤立的cellImage（没有被单元格引用）', image_id)
+
+        # 没有被任何关系引用的media成员（图片也可能被绘图等其他部件引用，因此检查所有关系部件）
+        rel_targets = set()
+        for name in members:
+            if name.endswith('.rels'):
+                directory, rels_name = posixpath.split(name)
+                source = posixpath.join(posixpath.dirname(directory), rels_name[:-len('.rels')])
+                rel_targets.update(target for _, _, target in read_rels(zip_ref, source))
+        for name in media.keys() - rel_targets:
+            findings.warning('孤立的图片成员（没有被关系引用）', name)
+
+    unique = len(images)
+    stats['deduplicated_cells'] = max(0, stats['image_cells'] - unique)
+    stats['elapsed'] = time.perf_counter() - start
+    return findings
+
+
+# 打印检查结果
+def print_findings(file_path, findings):
+    stats = findings.stats
+    print(f"检查Excel文件: {file_path}")
+    print(f"\n成员 {stats['members']} 个，压缩后 {stats['compressed_bytes'] / 1024 ** 2:.2f} MB，"
+          f"解压后 {stats['uncompressed_bytes'] / 1024 ** 2:.2f} MB")
+    print(f"工作表 {stats['sheets']} 个，图片单元格 {stats['image_cells']} 个，"
+          f"cellImage {stats['cell_images']} 个，图片关系 {stats['image_relationships']} 个，"
+          f"图片成员 {stats['media']} 个（{stats['media_bytes'] / 1024 ** 2:.2f} MB）")
+    for sheet_name, count in stats['image_cells_per_sheet'].items():
+        print(f"  {sheet_name}: {count} 个图片单元格")
+    if stats['deduplicated_cells']:
+        print(f"共用图片的单元格: {stats['deduplicated_cells']} 个")
+
+    for label, bucket in (('❌ 错误', findings.errors), ('⚠️ 警告', findings.warnings)):
+        for kind, entry in bucket.items():
+            print(f"\n{label}: {kind}（{entry['count']} 处）")
+            for detail in entry['examples']:
+                print(f"    {detail}")
+            if entry['count'] > len(entry['examples']):
+                print(f"    ...")
+    print(f"\n检查耗时 {stats['elapsed']:.2f} 秒")
+    if not findings.errors:
+        print("✅ 结构检查通过" + ("（有警告）" if findings.warnings else ""))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='检查WPS内嵌图片Excel文件的结构（不解压整个包）')
+    parser.add_argument('file', help='Excel文件')
+    parser.add_argument('--json', action='store_true', help='以JSON输出检查结果')
+    parser.add_argument('--dump', metavar='PART', action='append', default=[],
+                        help='把指定成员（例如xl/cellimages.xml）原样输出到标准输出，可以指定多次')
+    args = parser.parse_args(argv)
+
+    if args.dump:
+        with zipfile.ZipFile(args.file, 'r') as zip_ref:
+            # 先检查所有成员都存在，不输出一半内容后才失败；标准输出留给成员内容，错误写到标准错误
+            members = set(zip_ref.namelist())
+            missing = [part_name for part_name in args.dump if part_name not in members]
+            if missing:
+                print(f"❌ {args.file} 中找不到成员: {', '.join(missing)}", file=sys.stderr)
+                return 1
+            for part_name in args.dump:
+                with zip_ref.open(part_name) as f:
+                    while True:
+                        chunk = f.read(SCAN_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        sys.stdout.buffer.write(chunk)
+                sys.stdout.buffer.write(b'\n')
+        return 0
+
+    findings = examine_excel(args.file)
+    if args.json:
+        print(json.dumps({
+            'file': args.file, 'ok': not findings.errors, 'stats': findings.stats,
+            'errors': findings.errors, 'warnings': findings.warnings,
+        }, ensure_ascii=False, indent=2))
+    else:
+        print_findings(args.file, findings)
+    return 1 if findings.errors else 0
+
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python examine_excel.py <excel_file_path>")
-        sys.exit(1)
-    file_path = sys.argv[1]
-    examine_excel(file_path)
+    sys.exit(main())
@@ -1,465 +1,2639 @@
+import io
 import os
+import re
+import csv
 import sys
+import time
 import uuid
+import json
+import mmap
+import logging
+import argparse
+import struct
+import hashlib
+import threading
 import shutil
 import zipfile
+import itertools
 import tempfile
-from PIL import Image
-import lxml.etree as etree
+import posixpath
+import importlib
+import contextlib
+from collections import deque, namedtuple
 
-# 确保图片目录存在
+
+# 按需导入的模块：第一次访问属性时才真正导入，
+# import本模块时不加载Pillow和lxml，也不做任何文件系统操作
+class _LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+Image = _LazyModule('PIL.Image')
+ImageOps = _LazyModule('PIL.ImageOps')
+etree = _LazyModule('lxml.etree')
+
+# 进度和结果通过logging输出，库调用方可以按需调整级别；命令行默认输出INFO级别
+logger = logging.getLogger('insert_images_wps_embedded')
+
+# 默认的图片目录和输出文件
 IMG_DIR = './img'
-if not os.path.exists(IMG_DIR):
-    os.makedirs(IMG_DIR)
-    print(f"创建了目录: {IMG_DIR}")
-    print("请将图片文件放入该目录后重新运行脚本")
-    sys.exit(1)
-
-# 获取图片文件列表
-image_files = []
-for file in os.listdir(IMG_DIR):
-    if file.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')):
-        image_files.append(os.path.join(IMG_DIR, file))
-
-if not image_files:
-    print(f"目录 {IMG_DIR} 中没有找到图片文件")
-    sys.exit(1)
+OUTPUT_EXCEL = 'images_wps_embedded.xlsx'
+
+# 支持的图片扩展名
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+
+# 获取目录中的图片文件列表（按文件名排序，保证单元格分配稳定）
+def find_image_files(img_dir):
+    return [
+        os.path.join(img_dir, name)
+        for name in sorted(os.listdir(img_dir))
+        if name.lower().endswith(IMAGE_EXTENSIONS)
+    ]
+
+
+# 读取清单文件：每行一个图片路径，空行和#开头的行会被忽略，相对路径相对于清单文件所在目录
+def read_image_list(manifest_path):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                yield os.path.join(base_dir, line)
+
+
+# CSV/JSONL清单中的保留字段，其余字段都是行数据
+MANIFEST_FIELDS = ('image', 'cell', 'sheet')
+MANIFEST_EXTENSIONS = ('.csv', '.jsonl', '.ndjson')
+
+# 可以按数字写入的文本：不含前导0（避免编号丢失前导0），最多15位有效数字（Excel的精度）
+NUMBER_PATTERN = re.compile(r'^-?(0|[1-9][0-9]{0,14})(\.[0-9]{1,15})?$')
+
+
+# 清单内容有误，信息中包含清单文件和出错的行号
+class ManifestError(ValueError):
+    pass
+
+
+# 逐条读取CSV或JSONL清单（.jsonl/.ndjson为每行一个JSON对象，其余按带表头的CSV读取），
+# 生成 (行号, 记录字典)，不把整个清单读入内存。CSV的行号是记录结束处的文件行号
+def read_manifest_records(manifest_path):
+    extension = os.path.splitext(manifest_path)[1].lower()
+    with open(manifest_path, 'r', encoding='utf-8-sig', newline='') as f:
+        if extension not in ('.jsonl', '.ndjson'):
+            reader = csv.DictReader(f)
+            for record in reader:
+                yield reader.line_num, record
+            return
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                raise ManifestError(f"{manifest_path} 第{line_number}行不是有效的JSON: {e}")
+            if not isinstance(record, dict):
+                raise ManifestError(f"{manifest_path} 第{line_number}行不是JSON对象")
+            yield line_number, record
+
+
+# 数据单元格的值：CSV中的数字文本按数字写入，JSON按原有类型写入，空值不写
+def manifest_value(value):
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        return float(value) if NUMBER_PATTERN.match(value) else value
+    if isinstance(value, (bool, int, float)):
+        return value
+    return json.dumps(value, ensure_ascii=False)
+
+
+# 按清单生成 (工作表名, 图片单元格, 图片路径, [(行号, 列号, 值), ...])：
+#   - 没有cell字段的记录每条占一行：第1行是表头（图片列和数据字段名，以工作表中第一条记录的字段为准），
+#     记录从第2行开始，图片在image_column列，数据字段依次写在其右侧
+#   - 有cell字段的记录图片放在该单元格，数据字段按记录中的顺序写在同一行的右侧
+# 相对路径相对于清单文件所在目录。
+# 数据按constant_memory模式逐行写入，同一个工作表中带数据的记录行号必须递增；
+# 记录有误时抛出ManifestError，指出清单中的行号
+def manifest_entries(manifest_path, image_column='A', sheet_name=None):
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    image_col = column_index(image_column)
+    headers = {}
+    next_rows = {}
+    last_rows = {}
+    for line_number, record in read_manifest_records(manifest_path):
+        image_path = record.get('image')
+        if not image_path:
+            raise ManifestError(f"{manifest_path} 第{line_number}行缺少image字段")
+        sheet = record.get('sheet') or sheet_name or 'Sheet1'
+        fields = [key for key in record if key not in MANIFEST_FIELDS]
+        try:
+            validate_sheet_name(sheet)
+            if record.get('cell'):
+                row, col = cell_to_rowcol(record['cell'])
+        except (TypeError, ValueError) as e:
+            raise ManifestError(f"{manifest_path} 第{line_number}行: {e}")
+
+        data = []
+        if not record.get('cell'):
+            if sheet not in headers:
+                headers[sheet] = {field: image_col + 1 + i for i, field in enumerate(fields)}
+                next_rows[sheet] = 1
+                data.append((0, image_col, '图片'))
+                data.extend((0, col, field) for field, col in headers[sheet].items())
+            row, col = next_rows[sheet], image_col
+            next_rows[sheet] += 1
+            fields = [field for field in fields if field in headers[sheet]]
+
+        for i, field in enumerate(fields):
+            value = manifest_value(record[field])
+            if value is not None:
+                target_col = headers[sheet][field] if not record.get('cell') else col + 1 + i
+                data.append((row, target_col, value))
+        if data:
+            if data[0][0] < last_rows.get(sheet, 0):
+                raise ManifestError(
+                    f"{manifest_path} 第{line_number}行: 工作表 {sheet} 中带数据的记录必须按行号递增"
+                    f"（第{data[0][0] + 1}行排在第{last_rows[sheet] + 1}行之后）"
+                )
+            last_rows[sheet] = data[-1][0]
+        yield sheet, rowcol_to_cell(row, col), os.path.join(base_dir, image_path), data
+
+
+# 图片单元格的列宽（字符数）和行高（磅）
+COLUMN_WIDTH = 30
+ROW_HEIGHT = 150
 
 # 步骤1: 使用XlsxWriter创建基础Excel文件
-def create_base_excel():
-    print("创建基础Excel文件...")
+# 默认只包含一个空工作表，保存在内存中，图片单元格、列宽和行高都由包模型按映射写入。
+# 传入rows时按 (工作表名, [(行号, 列号, 值), ...]) 写入数据单元格，使用constant_memory模式
+# 逐行写入output文件，数据再多内存占用也不变；每个工作表中的行号必须递增
+def create_base_excel(sheet_name='Sheet1', rows=None, output=None):
+    logger.info("创建基础Excel文件...")
     import xlsxwriter
     
-    # 创建临时Excel文件
-    temp_excel = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
-    temp_excel.close()
-    
-    workbook = xlsxwriter.Workbook(temp_excel.name)
-    worksheet = workbook.add_worksheet()
-    
-    # 设置列宽和行高
-    for i in range(len(image_files)):
-        column_letter = chr(ord('B') + i)
-        worksheet.set_column(f'{column_letter}:{column_letter}', 30)
-    worksheet.set_row(0, 150)
-    
-    # 先在单元格中添加占位内容
-    for i in range(len(image_files)):
-        column_letter = chr(ord('B') + i)
-        cell_address = f'{column_letter}1'
-        worksheet.write(cell_address, f"=DISPIMG(\"PLACEHOLDER\",1)")
-        print(f"已准备单元格: {cell_address}")
-    
+    if rows is None:
+        # 基础文件只保存在内存中，不落盘
+        base_excel = io.BytesIO()
+        workbook = xlsxwriter.Workbook(base_excel, {'in_memory': True})
+        workbook.add_worksheet(sheet_name)
+        workbook.close()
+        base_excel.seek(0)
+        return base_excel
+
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheets = {}
+    last_rows = {}
+    for name, cells in rows:
+        worksheet = worksheets.get(name)
+        if worksheet is None:
+            worksheet = worksheets[name] = workbook.add_worksheet(name)
+        for row, col, value in cells:
+            # constant_memory模式下已经写出的行不能再修改
+            if row < last_rows.get(name, 0):
+                raise ValueError(f"工作表 {name} 中的数据行必须按行号递增: 第{row + 1}行")
+            last_rows[name] = row
+            if isinstance(value, bool):
+                worksheet.write_boolean(row, col, value)
+            elif isinstance(value, (int, float)):
+                worksheet.write_number(row, col, value)
+            else:
+                worksheet.write_string(row, col, value)
+    if not worksheets:
+        workbook.add_worksheet(sheet_name)
     workbook.close()
-    return temp_excel.name
-
-# 步骤2: 解压Excel文件
-def unzip_excel(excel_path, extract_dir):
-    print(f"解压Excel文件到: {extract_dir}")
-    with zipfile.ZipFile(excel_path, 'r') as zip_ref:
-        zip_ref.extractall(extract_dir)
-
-# 步骤3: 复制图片到Excel的media目录
-def copy_image_to_excel(image_path, extract_dir):
-    media_dir = os.path.join(extract_dir, 'xl', 'media')
-    if not os.path.exists(media_dir):
-        os.makedirs(media_dir)
-    
-    # 生成唯一的图片文件名
-    image_ext = os.path.splitext(image_path)[1]
-    image_name = f'image_{uuid.uuid4().hex}{image_ext}'
-    dest_path = os.path.join(media_dir, image_name)
-    
-    # 复制图片
-    shutil.copy(image_path, dest_path)
-    return image_name, dest_path
-
-# 步骤4: 修改Content_Types.xml
-def update_content_types(extract_dir):
-    content_types_path = os.path.join(extract_dir, '[Content_Types].xml')
-    parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
-    tree = etree.parse(content_types_path, parser)
-    root = tree.getroot()
-    
-    # 添加cellimages.xml的内容类型
-    if root.find('{http://schemas.openxmlformats.org/package/2006/content-types}Override[@PartName="/xl/cellimages.xml"]') is None:
-        xml_string = '''<Override PartName="/xl/cellimages.xml" ContentType="application/vnd.wps-officedocument.cellimage+xml"/>'''
-        new_elem = etree.fromstring(xml_string, parser)
-        root.append(new_elem)
-    
-    # 添加jpeg内容类型（如果需要）
-    if root.find('{http://schemas.openxmlformats.org/package/2006/content-types}Default[@Extension="jpeg"]') is None:
-        xml_string = '''<Default Extension="jpeg" ContentType="image/jpeg"/>'''
-        new_elem = etree.fromstring(xml_string, parser)
-        root.append(new_elem)
-    
-    tree.write(content_types_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    print("已更新Content_Types.xml")
-
-# 步骤5: 修改workbook.xml.rels
-def update_workbook_rels(extract_dir):
-    workbook_rels_path = os.path.join(extract_dir, 'xl', '_rels', 'workbook.xml.rels')
-    parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
-    tree = etree.parse(workbook_rels_path, parser)
-    root = tree.getroot()
-    
-    # 检查是否已存在cellimages.xml的关系
-    if root.find('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship[@Target="cellimages.xml"]') is None:
-        # 生成新的rId
-        r_ids = []
-        for rel in root.findall('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
-            r_id = rel.get('Id')
-            if r_id.startswith('rId'):
-                try:
-                    num = int(r_id[3:])
-                    r_ids.append(num)
-                except ValueError:
-                    pass
-        
-        new_r_id = f'rId{max(r_ids) + 1}' if r_ids else 'rId1'
-        
-        # 添加关系
-        xml_string = f'''<Relationship Id="{new_r_id}" Type="http://www.wps.cn/officeDocument/2020/cellImage" Target="cellimages.xml"/>'''  # 保持与正常文件相同的类型
-        new_elem = etree.fromstring(xml_string, parser)
-        root.append(new_elem)
-    
-    tree.write(workbook_rels_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    print("已更新workbook.xml.rels")
+    return output
 
-# 步骤6: 创建或更新cellimages.xml
-def update_cellimages(extract_dir, image_name, image_path):
-    cellimages_path = os.path.join(extract_dir, 'xl', 'cellimages.xml')
-    
-    # 如果文件不存在，创建它
-    if not os.path.exists(cellimages_path):
-        # 创建带有正确命名空间的根元素
-        root = etree.Element(
-            '{http://www.wps.cn/officeDocument/2017/etCustomData}cellImages',
-            nsmap={
-                'xdr': 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing',
-                'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships',
-                'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
-                'etc': 'http://www.wps.cn/officeDocument/2017/etCustomData'
-            }
-        )
-        tree = etree.ElementTree(root)
-        tree.write(cellimages_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    
-    # 解析现有文件
-    parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
-    tree = etree.parse(cellimages_path, parser)
-    root = tree.getroot()
-    
-    # 生成唯一ID
-    image_id = f'ID_{uuid.uuid4().hex}'
-    
-    # 获取现有rId的最大值（从cellimages.xml.rels中获取，而不是cellimages.xml）
-    r_ids = []
-    cellimages_rels_path = os.path.join(extract_dir, 'xl', '_rels', 'cellimages.xml.rels')
-    if os.path.exists(cellimages_rels_path):
-        rels_tree = etree.parse(cellimages_rels_path, parser)
-        rels_root = rels_tree.getroot()
-        for rel in rels_root.findall('{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'):
-            r_id = rel.get('Id')
-            if r_id and r_id.startswith('rId'):
-                try:
-                    num = int(r_id[3:])
-                    r_ids.append(num)
-                except ValueError:
-                    pass
-    
-    # 也检查cellimages.xml中的r:embed
-    for img in root.findall('{http://www.wps.cn/officeDocument/2017/etCustomData}cellImage'):
-        pic = img.find('{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}pic')
-        if pic is not None:
-            blipFill = pic.find('{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}blipFill')
-            if blipFill is not None:
-                blip = blipFill.find('{http://schemas.openxmlformats.org/drawingml/2006/main}blip')
-                if blip is not None:
-                    r_id = blip.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                    if r_id and r_id.startswith('rId'):
-                        try:
-                            num = int(r_id[3:])
-                            r_ids.append(num)
-                        except ValueError:
-                            pass
-    
-    new_r_id = f'rId{max(r_ids) + 1}' if r_ids else 'rId1'
-    
-    # 获取图片尺寸
-    with Image.open(image_path) as img:
-        width, height = img.size
-    
-    # 将像素转换为EMU（Excel内部单位，1像素=9525 EMU）
-    width_emu = width * 9525
-    height_emu = height * 9525
-    
-    # 添加新的cellImage元素，使用正确的WPS格式
-    cell_image = etree.SubElement(
-        root,
-        '{http://www.wps.cn/officeDocument/2017/etCustomData}cellImage'
-    )
-    
-    # 添加pic元素
-    pic = etree.SubElement(
-        cell_image,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}pic'
-    )
-    
-    # 添加nvPicPr元素
-    nv_pic_pr = etree.SubElement(
-        pic,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}nvPicPr'
-    )
-    
-    # 添加cNvPr元素
-    c_nv_pr = etree.SubElement(
-        nv_pic_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}cNvPr',
-        id='2',  # 这里可以考虑递增ID
-        name=image_id
-    )
-    
-    # 添加cNvPicPr元素
-    c_nv_pic_pr = etree.SubElement(
-        nv_pic_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}cNvPicPr'
-    )
-    
-    # 添加picLocks元素
-    pic_locks = etree.SubElement(
-        c_nv_pic_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}picLocks',
-        noChangeAspect='1'
-    )
-    
-    # 添加blipFill元素
-    blip_fill = etree.SubElement(
-        pic,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}blipFill'
-    )
-    
-    # 添加blip元素
-    blip = etree.SubElement(
-        blip_fill,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}blip',
-        **{'{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed': new_r_id}
-    )
-    
-    # 添加stretch元素
-    stretch = etree.SubElement(
-        blip_fill,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}stretch'
-    )
-    
-    # 添加fillRect元素
-    fill_rect = etree.SubElement(
-        stretch,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}fillRect'
-    )
-    
-    # 添加spPr元素
-    sp_pr = etree.SubElement(
-        pic,
-        '{http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing}spPr'
-    )
-    
-    # 添加xfrm元素
-    xfrm = etree.SubElement(
-        sp_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}xfrm'
+# 命名空间和关系类型
+NS_CT = 'http://schemas.openxmlformats.org/package/2006/content-types'
+NS_REL = 'http://schemas.openxmlformats.org/package/2006/relationships'
+NS_MAIN = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+NS_XDR = 'http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing'
+NS_A = 'http://schemas.openxmlformats.org/drawingml/2006/main'
+NS_R = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+NS_ETC = 'http://www.wps.cn/officeDocument/2017/etCustomData'
+REL_TYPE_IMAGE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/image'
+REL_TYPE_CELLIMAGE = 'http://www.wps.cn/officeDocument/2020/cellImage'  # 保持与正常文件相同的类型
+REL_TYPE_WORKSHEET = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet'
+CELLIMAGES_CONTENT_TYPE = 'application/vnd.wps-officedocument.cellimage+xml'
+WORKSHEET_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml'
+
+# 新建工作表使用的XML
+EMPTY_WORKSHEET_XML = (
+    f'<worksheet xmlns="{NS_MAIN}" xmlns:r="{NS_R}">'
+    '<dimension ref="A1"/>'
+    '<sheetFormatPr defaultRowHeight="15"/>'
+    '<sheetData/>'
+    '<pageMargins left="0.7" right="0.7" top="0.75" bottom="0.75" header="0.3" footer="0.3"/>'
+    '</worksheet>'
+).encode('utf-8')
+
+# Excel的行列上限（最大列为XFD）
+MAX_ROWS = 1048576
+MAX_COLUMNS = 16384
+
+CELL_REF_PATTERN = re.compile(r'^\$?([A-Za-z]{1,3})\$?([0-9]+)$')
+
+
+# 列号（从0开始）转换为列字母，0 -> A，16383 -> XFD
+def column_letter(col_index):
+    if not 0 <= col_index < MAX_COLUMNS:
+        raise ValueError(f"列号超出范围: {col_index}")
+    letters = ''
+    col_index += 1
+    while col_index:
+        col_index, remainder = divmod(col_index - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+
+# 列字母转换为列号（从0开始），A -> 0，XFD -> 16383
+def column_index(letters):
+    index = 0
+    for char in letters.upper():
+        if not 'A' <= char <= 'Z':
+            raise ValueError(f"无效的列字母: {letters}")
+        index = index * 26 + ord(char) - ord('A') + 1
+    if not 1 <= index <= MAX_COLUMNS:
+        raise ValueError(f"列超出范围: {letters}")
+    return index - 1
+
+
+# 单元格地址转换为 (行号, 列号)，都从0开始，支持$B$3这样的绝对引用
+def cell_to_rowcol(cell_address):
+    match = CELL_REF_PATTERN.match(cell_address)
+    if match is None:
+        raise ValueError(f"无效的单元格地址: {cell_address}")
+    row = int(match.group(2))
+    if not 1 <= row <= MAX_ROWS:
+        raise ValueError(f"行号超出范围: {cell_address}")
+    return row - 1, column_index(match.group(1))
+
+
+# (行号, 列号)（都从0开始）转换为单元格地址，(0, 1) -> B1
+def rowcol_to_cell(row_index, col_index):
+    if not 0 <= row_index < MAX_ROWS:
+        raise ValueError(f"行号超出范围: {row_index}")
+    return f'{column_letter(col_index)}{row_index + 1}'
+
+
+# 检查工作表名是否符合Excel的限制
+def validate_sheet_name(sheet_name):
+    if not sheet_name or len(sheet_name) > 31:
+        raise ValueError(f"工作表名长度必须在1到31个字符之间: {sheet_name!r}")
+    if any(char in sheet_name for char in '[]:*?/\\') or sheet_name.startswith("'") \
+            or sheet_name.endswith("'"):
+        raise ValueError(f"工作表名包含不允许的字符: {sheet_name!r}")
+
+# 图片扩展名对应的内容类型
+IMAGE_CONTENT_TYPES = {
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'bmp': 'image/bmp',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+    'tif': 'image/tiff',
+    'tiff': 'image/tiff',
+}
+
+# 1像素=9525 EMU（Excel内部单位）
+EMU_PER_PIXEL = 9525
+
+# 图片准备阶段默认的并发数，与ThreadPoolExecutor的默认值一致
+DEFAULT_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# 本身已经压缩过的图片格式，再用deflate压缩几乎没有收益
+COMPRESSED_IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+
+# 输出配置：
+#   xml_level        XML等部件（以及BMP这类未压缩图片）的deflate压缩级别
+#   store_compressed 已压缩的图片格式是否直接存储（ZIP_STORED）
+OUTPUT_PROFILES = {
+    'fast': {'xml_level': 1, 'store_compressed': True},
+    'small': {'xml_level': 9, 'store_compressed': False},
+}
+DEFAULT_PROFILE = 'fast'
+
+
+# 按成员决定压缩方式，返回 (compress_type, compresslevel)
+def member_compression(member_name, profile=DEFAULT_PROFILE, xml_level=None):
+    settings = OUTPUT_PROFILES[profile]
+    level = settings['xml_level'] if xml_level is None else xml_level
+    if member_name.lower().endswith(COMPRESSED_IMAGE_EXTENSIONS):
+        if settings['store_compressed']:
+            return zipfile.ZIP_STORED, None
+        return zipfile.ZIP_DEFLATED, 9
+    return zipfile.ZIP_DEFLATED, level
+
+
+# 按压缩策略生成ZipInfo，用于ZipFile.open(..., 'w')流式写入
+def new_zip_info(member_name, profile=DEFAULT_PROFILE, xml_level=None, date_time=None):
+    info = zipfile.ZipInfo(member_name, date_time=date_time or time.localtime()[:6])
+    info.compress_type, level = member_compression(member_name, profile, xml_level)
+    # ZipFile.open(zinfo, 'w')没有压缩级别参数，只能通过ZipInfo传递
+    info._compresslevel = level
+    # 与ZipFile.write一致的普通文件权限
+    info.external_attr = 0o600 << 16
+    return info
+
+
+# 把一个成员的压缩数据原样从src_zip复制到dst_zip，不解压也不重新压缩。
+# zipfile没有公开的原样复制接口，这里按zipfile自己的写法写入本地文件头和数据，
+# 再把成员登记到dst_zip的中央目录
+def copy_raw_member(src_zip, dst_zip, info):
+    src = src_zip.fp
+    src.seek(info.header_offset)
+    header = src.read(zipfile.sizeFileHeader)
+    if len(header) != zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"成员的本地文件头损坏: {info.filename}")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    src.seek(name_length + extra_length, os.SEEK_CUR)
+
+    out_info = zipfile.ZipInfo(info.filename, info.date_time)
+    out_info.compress_type = info.compress_type
+    out_info.CRC = info.CRC
+    out_info.compress_size = info.compress_size
+    out_info.file_size = info.file_size
+    out_info.create_system = info.create_system
+    out_info.external_attr = info.external_attr
+    # CRC和大小直接写在本地文件头中，不再需要数据描述符
+    out_info.flag_bits = info.flag_bits & ~0x08
+
+    dst = dst_zip.fp
+    if dst_zip._seekable:
+        dst.seek(dst_zip.start_dir)
+    out_info.header_offset = dst.tell()
+    dst.write(out_info.FileHeader())
+    remaining = info.compress_size
+    while remaining:
+        chunk = src.read(min(remaining, 1024 * 1024))
+        if not chunk:
+            raise zipfile.BadZipFile(f"成员数据不完整: {info.filename}")
+        dst.write(chunk)
+        remaining -= len(chunk)
+
+    dst_zip.filelist.append(out_info)
+    dst_zip.NameToInfo[out_info.filename] = out_info
+    dst_zip.start_dir = dst.tell()
+
+
+# 只读取文件头获取图片尺寸，覆盖PNG IHDR、JPEG SOF、GIF和BMP头，
+# 无法识别的文件才回退到Pillow
+def _probe_png(f):
+    head = f.read(24)
+    if len(head) < 24 or head[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', head[16:24])
+
+
+def _probe_gif(f):
+    head = f.read(10)
+    if len(head) < 10:
+        return None
+    return struct.unpack('<HH', head[6:10])
+
+
+def _probe_bmp(f):
+    head = f.read(26)
+    if len(head) < 26:
+        return None
+    header_size = struct.unpack('<I', head[14:18])[0]
+    if header_size == 12:
+        # BITMAPCOREHEADER使用16位宽高
+        return struct.unpack('<HH', head[18:22])
+    width, height = struct.unpack('<ii', head[18:26])
+    # 高度为负数表示自上而下存储的位图
+    return abs(width), abs(height)
+
+
+def _probe_jpeg(f):
+    f.seek(2)
+    while True:
+        byte = f.read(1)
+        if byte != b'\xff':
+            return None
+        # 跳过标记前的填充字节0xFF
+        while byte == b'\xff':
+            byte = f.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        # 没有长度字段的独立标记
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue
+        segment = f.read(2)
+        if len(segment) < 2:
+            return None
+        length = struct.unpack('>H', segment)[0]
+        # SOF0-SOF15（0xC4 DHT、0xC8 JPG、0xCC DAC除外）中记录了图像尺寸
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            sof = f.read(5)
+            if len(sof) < 5:
+                return None
+            height, width = struct.unpack('>HH', sof[1:5])
+            return width, height
+        f.seek(length - 2, os.SEEK_CUR)
+
+
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', _probe_png),
+    (b'\xff\xd8', _probe_jpeg),
+    (b'GIF87a', _probe_gif),
+    (b'GIF89a', _probe_gif),
+    (b'BM', _probe_bmp),
+)
+
+
+# 内存中的图片数据：bytes、bytearray、memoryview或mmap映射
+BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+
+# 以文件接口读取内存缓冲区（包括mmap映射），只复制实际读取的部分，
+# 尺寸探测和Pillow解码不需要先把整个缓冲区复制到BytesIO中。
+# 继承io.RawIOBase，readline、readinto等完整的文件接口都可用（Pillow逐个尝试插件时会用到）
+class BufferReader(io.RawIOBase):
+    def __init__(self, data):
+        super().__init__()
+        self.view = memoryview(data)
+        self.pos = 0
+
+    def readinto(self, buffer):
+        end = min(self.pos + len(buffer), len(self.view))
+        size = max(0, end - self.pos)
+        buffer[:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def read(self, size=-1):
+        end = len(self.view) if size is None or size < 0 else min(self.pos + size, len(self.view))
+        chunk = self.view[self.pos:end].tobytes()
+        self.pos = max(self.pos, end)
+        return chunk
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.pos = max(0, offset)
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    # Pillow无法识别时的错误信息中显示
+    def __repr__(self):
+        return f'<{len(self.view)} 字节的图片数据>'
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    # 释放对缓冲区的引用，之后mmap才能关闭
+    def close(self):
+        self.view.release()
+        super().close()
+
+
+# 获取图片的像素尺寸 (width, height)，source可以是文件路径或内存中的图片数据
+def probe_image_size(source):
+    if isinstance(source, BUFFER_TYPES):
+        f = BufferReader(source)
+    else:
+        f = open(source, 'rb')
+
+    with f:
+        head = f.read(8)
+        for signature, probe in IMAGE_SIGNATURES:
+            if head.startswith(signature):
+                f.seek(0)
+                size = probe(f)
+                if size is not None and size[0] > 0 and size[1] > 0:
+                    return tuple(size)
+                break
+
+        # 不常见的格式或文件头异常时回退到Pillow
+        f.seek(0)
+        with Image.open(f) as img:
+            return img.size
+
+
+# 批量获取多张图片的尺寸，按输入顺序返回
+def probe_image_sizes(sources, workers=8):
+    sources = list(sources)
+    if workers <= 1 or len(sources) <= 1:
+        return [probe_image_size(source) for source in sources]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(probe_image_size, sources))
+
+
+# 可选的图片变换：
+#   max_width/max_height 最大像素框，超出时等比缩小（None表示不限制）
+#   convert_to           把BMP/PNG照片转换为'jpeg'或'webp'（None表示保持原格式）
+#   quality              JPEG/WebP的编码质量
+ImageTransform = namedtuple(
+    'ImageTransform', 'max_width max_height convert_to quality',
+    defaults=(None, None, None, 85)
+)
+
+# 扩展名对应的Pillow格式名
+PIL_FORMATS = {
+    '.png': 'PNG',
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.bmp': 'BMP',
+    '.gif': 'GIF',
+    '.webp': 'WEBP',
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+}
+
+
+# 由列宽（字符数）和行高（磅）换算单元格的像素框，换算方式与XlsxWriter一致
+def cell_pixel_box(column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT):
+    if column_width < 1:
+        width = int(column_width * 12 + 0.5)
+    else:
+        width = int(column_width * 7 + 0.5) + 5
+    height = int(row_height * 4 / 3)
+    return width, height
+
+
+# 生成把图片缩放到目标单元格大小的变换
+def fit_to_cell_transform(column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT,
+                          convert_to=None, quality=85):
+    max_width, max_height = cell_pixel_box(column_width, row_height)
+    return ImageTransform(max_width, max_height, convert_to, quality)
+
+
+# 按变换参数缩小和/或重新编码图片，返回 (data, extension, width, height)。
+# 不需要变换的图片原样返回，不经过Pillow
+def transform_image(data, extension, width, height, transform):
+    too_large = (
+        (transform.max_width and width > transform.max_width)
+        or (transform.max_height and height > transform.max_height)
     )
-    
-    # 添加off元素
-    off = etree.SubElement(
-        xfrm,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}off',
-        x='0',
-        y='0'
+    convert_to = transform.convert_to if extension in ('.png', '.bmp') else None
+    if not too_large and not convert_to:
+        return data, extension, width, height
+
+    with BufferReader(data) as f, Image.open(f) as img:
+        # 动图缩放会丢失动画，保持原样
+        if getattr(img, 'is_animated', False):
+            return data, extension, width, height
+
+        # 按EXIF方向摆正，重新编码后方向信息会丢失
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ('P', '1'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        if too_large:
+            img.thumbnail(
+                (transform.max_width or width, transform.max_height or height),
+                Image.LANCZOS
+            )
+
+        new_extension = f'.{convert_to}' if convert_to else extension
+        image_format = PIL_FORMATS[new_extension]
+        options = {}
+        if image_format in ('JPEG', 'WEBP'):
+            options['quality'] = transform.quality
+        if image_format in ('JPEG', 'BMP') and img.mode not in ('RGB', 'L'):
+            # JPEG和BMP不支持透明通道，铺在白色背景上
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            if img.mode in ('RGBA', 'LA'):
+                background.paste(img, mask=img.getchannel('A'))
+            else:
+                background.paste(img.convert('RGB'))
+            img = background
+
+        output = io.BytesIO()
+        img.save(output, image_format, **options)
+        return output.getvalue(), new_extension, img.width, img.height
+
+
+# 内存中的图片源：data是图片数据（bytes-like），name是可选的显示名称，其扩展名优先于按文件头识别的格式。
+# 例如服务收到的图片不需要先写入磁盘，直接作为映射中的图片源传入
+ImageSource = namedtuple('ImageSource', 'data name', defaults=(None,))
+
+# 大于该大小的源文件用mmap映射：哈希、尺寸探测和写入输出包都直接读取映射，不复制到进程内存
+MMAP_THRESHOLD = 4 * 1024 * 1024
+
+# 按文件头识别图片格式
+EXTENSION_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', '.png'),
+    (b'\xff\xd8', '.jpg'),
+    (b'GIF87a', '.gif'),
+    (b'GIF89a', '.gif'),
+    (b'BM', '.bmp'),
+    (b'II*\x00', '.tiff'),
+    (b'MM\x00*', '.tiff'),
+)
+
+
+# 图片源的显示名称：文件路径原样返回，文件对象和ImageSource使用name，否则为<内存图片>
+def source_name(source):
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    name = getattr(source, 'name', None)
+    return name if isinstance(name, str) else '<内存图片>'
+
+
+# 图片的扩展名：优先使用文件名中已知的图片扩展名，否则按文件头识别。
+# 只接受能在[Content_Types].xml中声明正确内容类型的格式（IMAGE_CONTENT_TYPES）
+def source_extension(source, data):
+    extension = os.path.splitext(source_name(source))[1].lower()
+    if extension[1:] in IMAGE_CONTENT_TYPES:
+        return extension
+    with memoryview(data) as view:
+        head = view[:16].tobytes()
+    for signature, detected in EXTENSION_SIGNATURES:
+        if head.startswith(signature):
+            return detected
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    raise ValueError(f"不支持的图片格式: {source_name(source)}")
+
+
+# read_image_source自己打开的mmap映射，写入完成后由release_image_data关闭；
+# 调用方传入的mmap（直接传入或放在ImageSource中）属于调用方，不会被关闭
+class OwnedMapping(mmap.mmap):
+    pass
+
+
+# 图片源是否是文件对象（mmap也有read方法，但按缓冲区使用）
+def is_file_source(source):
+    return hasattr(source, 'read') and not isinstance(source, BUFFER_TYPES)
+
+
+# 读取图片源，每个源只读取一次：
+#   文件路径：小文件一次读入，大文件（use_mmap为True时）用mmap映射，之后各步骤共用这一份数据
+#   bytes-like或ImageSource：直接使用，不复制，也不会被关闭，可以用于多个单元格
+#   有read方法的文件对象：从当前位置读取到末尾，因此一个文件对象只能用于一个单元格
+def read_image_source(source, use_mmap=True):
+    if isinstance(source, ImageSource):
+        source = source.data
+    if isinstance(source, BUFFER_TYPES):
+        return source
+    if is_file_source(source):
+        data = source.read()
+        if not data:
+            raise ValueError(f"文件对象没有可读取的数据（可能已经被读取过，一个文件对象只能用于一个单元格）: "
+                             f"{source_name(source)}")
+        return data
+    with open(source, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if use_mmap and size >= MMAP_THRESHOLD:
+            return OwnedMapping(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return f.read()
+
+
+# 写入完成后关闭read_image_source自己打开的mmap映射，其他数据由垃圾回收释放
+def release_image_data(data):
+    if isinstance(data, OwnedMapping):
+        data.close()
+
+
+# 准备好的图片：图片源的显示名称、写入包中的数据、内容哈希、扩展名和像素尺寸
+# cached表示结果是否来自磁盘缓存，source_size和elapsed是读取的源文件字节数和准备耗时（秒）
+PreparedImage = namedtuple(
+    'PreparedImage', 'source data digest extension width height cached source_size elapsed',
+    defaults=(False, 0, 0.0)
+)
+
+
+# 默认的缓存容量上限（字节）
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+
+# 已处理图片的本地磁盘缓存
+# 以“源图片内容哈希 + 变换参数”为键，保存准备好的图片字节和尺寸，
+# 重复运行时命中缓存的图片可以跳过尺寸探测和缩放/重新编码。
+# 每个条目是一个文件：第一行是JSON元数据，其后是图片字节；
+# 命中时更新文件的修改时间，超出容量时按修改时间淘汰最久未使用的条目（LRU）。
+# get/put只访问文件系统，可以在工作线程或工作进程中调用；
+# 命中统计和淘汰由主进程在写入阶段完成
+class ImageCache:
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def make_key(source_digest, transform):
+        params = repr(tuple(transform)) if transform is not None else 'original'
+        return hashlib.sha256(f'{source_digest}:{params}'.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.img')
+
+    # 返回 (data, digest, extension, width, height)，未命中时返回None
+    def get(self, key):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline())
+                data = f.read()
+        except (OSError, ValueError):
+            return None
+        if len(data) != meta.get('size'):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return data, meta['digest'], meta['extension'], meta['width'], meta['height']
+
+    def put(self, key, data, digest, extension, width, height):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        meta = {
+            'extension': extension, 'width': width, 'height': height,
+            'digest': digest, 'size': len(data),
+        }
+        # 先写临时文件再原子替换，并发写同一个键也不会读到半个文件
+        temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(data)
+        os.replace(temp_path, path)
+
+    def record(self, hit):
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    # 超出容量时删除最久未使用的条目
+    def evict(self):
+        entries = []
+        total = 0
+        for sub_entry in os.scandir(self.directory):
+            if not sub_entry.is_dir():
+                continue
+            for entry in os.scandir(sub_entry.path):
+                if not entry.name.endswith('.img'):
+                    continue
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        return total
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0.0
+        return (f"图片缓存: 命中 {self.hits}，未命中 {self.misses}，"
+                f"命中率 {hit_rate:.1f}%，淘汰 {self.evictions} 个条目")
+
+
+# 图片本身无法处理（文件缺失、格式无法识别、解码失败等），source是图片源的显示名称，
+# error是原始错误的类型和信息。图片已经读入内存，原始错误中只有缓冲区，没有路径
+class ImageError(ValueError):
+    def __init__(self, source, error):
+        super().__init__(source, error)
+        self.source = source
+        self.error = error
+
+    def __str__(self):
+        return f"无法处理图片 {self.source}: {self.error}"
+
+
+# 图片准备阶段：读取字节、探测尺寸、可选的缩放/重新编码、计算哈希。
+# source是文件路径、内存中的图片数据、文件对象或ImageSource，只读取一次，
+# 哈希、尺寸探测、缓存和写入输出包都使用同一份数据（大文件是mmap映射，写入后由写入阶段关闭）。
+# 不依赖包的状态，可以在线程池或进程池中并发执行（进程池中不能使用mmap，结果需要传回主进程）
+def prepare_image(source, transform=None, cache=None, use_mmap=True):
+    start = time.perf_counter()
+    name = source_name(source)
+    try:
+        data = read_image_source(source, use_mmap)
+    except (OSError, ValueError) as e:
+        raise ImageError(name, f'{type(e).__name__}: {e}') from e
+    source_size = len(data)
+
+    # 没有变换时准备只需要读取和探测尺寸，缓存原图只会多写一份副本，只在有变换时使用缓存
+    source_digest = None
+    cache_key = None
+    if cache is not None and transform is not None:
+        source_digest = hashlib.sha256(data).hexdigest()
+        cache_key = ImageCache.make_key(source_digest, transform)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            release_image_data(data)
+            return PreparedImage(
+                name, *entry, cached=True, source_size=source_size,
+                elapsed=time.perf_counter() - start
+            )
+
+    try:
+        width, height = probe_image_size(data)
+        extension = source_extension(source, data)
+        if transform is not None:
+            transformed = transform_image(data, extension, width, height, transform)
+            if transformed[0] is not data:
+                release_image_data(data)
+                source_digest = None
+            data, extension, width, height = transformed
+    except Exception as e:
+        release_image_data(data)
+        raise ImageError(name, f'{type(e).__name__}: {e}') from e
+    # 图片没有被变换时沿用已经算出的源图片哈希
+    digest = source_digest or hashlib.sha256(data).hexdigest()
+
+    if cache_key is not None:
+        cache.put(cache_key, data, digest, extension, width, height)
+    return PreparedImage(
+        name, data, digest, extension, width, height, source_size=source_size,
+        elapsed=time.perf_counter() - start
     )
-    
-    # 添加ext元素
-    ext = etree.SubElement(
-        xfrm,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}ext',
-        cx=str(width_emu),
-        cy=str(height_emu)
+
+
+# 跳过的图片：工作表、单元格、图片源的显示名称和错误信息
+ImageFailure = namedtuple('ImageFailure', 'sheet cell source error')
+
+# 检查点日志的格式版本
+JOURNAL_VERSION = 1
+
+
+# 检查点与本次任务不一致（参数或输入不同）
+class CheckpointError(ValueError):
+    pass
+
+
+# 检查点中准备好的图片文件，按内容哈希存放，相同的图片只保存一份
+def journal_media_path(media_dir, digest, extension):
+    return os.path.join(media_dir, digest[:2], f'{digest}{extension}')
+
+
+# 把准备好的图片写入检查点，已存在时跳过；先写临时文件再原子替换，中途退出不会留下半个文件
+def store_journal_media(media_dir, prepared):
+    path = journal_media_path(media_dir, prepared.digest, prepared.extension)
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(prepared.data)
+        os.replace(temp_path, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+        raise
+
+
+# 读取检查点中已准备好的图片，文件缺失或大小不符时返回None（需要重新准备）
+def load_journal_media(media_dir, entry, use_mmap=True):
+    path = journal_media_path(media_dir, entry['digest'], entry['extension'])
+    try:
+        if os.path.getsize(path) != entry['size']:
+            return None
+        data = read_image_source(path, use_mmap)
+    except OSError:
+        return None
+    return PreparedImage(
+        entry['source'], data, entry['digest'], entry['extension'], entry['width'], entry['height'],
+        True, len(data)
     )
-    
-    # 添加prstGeom元素
-    prst_geom = etree.SubElement(
-        sp_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}prstGeom',
-        prst='rect'
+
+
+# 流水线中的一个准备任务，在工作池中执行：
+#   entry是检查点中这张图片的记录，检查点中的图片文件完好时直接读取，跳过读取源文件、探测和缩放；
+#   media_dir不为None时把新准备好的图片写入检查点；
+#   skip_errors为True时图片本身的错误（文件缺失、格式无法识别、解码失败等）作为ImageFailure返回，
+#   不中断整个批次，写入检查点的错误（例如磁盘已满）仍然中止构建
+def prepare_job(source, transform=None, cache=None, use_mmap=True, media_dir=None, entry=None,
+                skip_errors=False):
+    if entry is not None:
+        prepared = load_journal_media(media_dir, entry, use_mmap)
+        if prepared is not None:
+            return prepared
+    try:
+        prepared = prepare_image(source, transform, cache, use_mmap)
+    except Exception as e:
+        if not skip_errors:
+            raise
+        error = e.error if isinstance(e, ImageError) else f'{type(e).__name__}: {e}'
+        return ImageFailure(None, None, source_name(source), error)
+    if media_dir is not None:
+        store_journal_media(media_dir, prepared)
+    return prepared
+
+
+# 检查点中记录的源文件标识 [大小, 修改时间]，源文件被修改后不再沿用检查点中准备好的图片；
+# 内存中的图片和文件对象没有标识，返回None
+def source_identity(source):
+    if not isinstance(source, (str, os.PathLike)):
+        return None
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+# 可恢复构建的检查点日志
+# 目录中的journal.jsonl第一行记录格式版本和任务参数，其后每行是一张已写入输出包的图片：
+# 在任务中的序号、工作表、单元格、图片源及其文件标识（大小和修改时间）、内容哈希、扩展名、尺寸，
+# 以及分配的media文件名、图片ID和关系ID；
+# 准备好的图片按内容哈希保存在media目录中（由工作池在准备阶段写入）。
+# 构建中途失败（磁盘已满、进程被终止等）后用同一个目录重新运行，已记录的图片直接从media目录读取，
+# 沿用原来的ID，不再读取源文件和缩放，只重新组装输出包；新分配的ID避开日志中的所有ID。
+# 每行写入后立即flush，进程中途退出时最多丢失最后一行，加载时忽略不完整的行。
+# 日志按序号和图片源匹配任务，参数或输入不同的检查点拒绝沿用；
+# 源文件在两次运行之间被修改过（大小或修改时间不同）时重新准备这张图片。
+# 内存中的图片没有文件标识，总是重新准备
+class BuildJournal:
+    def __init__(self, directory, params):
+        self.directory = directory
+        self.path = os.path.join(directory, 'journal.jsonl')
+        self.media_dir = os.path.join(directory, 'media')
+        # 经过一次JSON往返，元组和列表按相同的值比较
+        self.header = json.loads(json.dumps({'version': JOURNAL_VERSION, 'params': params}))
+        self.entries = {}
+        self.resumed = 0
+        os.makedirs(self.media_dir, exist_ok=True)
+
+        needs_newline = self._load()
+        if needs_newline is None:
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._write(self.header)
+        else:
+            self._file = open(self.path, 'a', encoding='utf-8')
+            if needs_newline:
+                self._file.write('\n')
+
+    # 读取已有的日志。没有日志或日志头不完整时返回None（重新开始），否则返回最后一行是否缺少换行
+    def _load(self):
+        try:
+            f = open(self.path, encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        with f:
+            line = f.readline()
+            try:
+                header = json.loads(line)
+            except ValueError:
+                return None
+            if header != self.header:
+                raise CheckpointError(
+                    f"检查点 {self.directory} 属于参数不同的另一个任务，请换一个目录或删除后重新运行"
+                )
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry['index']] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return not line.endswith('\n')
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    # 日志中已经使用的名称和关系ID登记到分配器，本次新分配的ID不会和沿用的ID冲突
+    def reserve(self, ids):
+        ids.seed_names(
+            name for entry in self.entries.values() for name in (entry['media'], entry['id'])
+        )
+        ids.seed_r_ids('cellimages', [entry['rid'] for entry in self.entries.values()])
+
+    # 第index个任务在日志中可以沿用的记录；同一序号的工作表、单元格或图片源不同说明输入已经变化，拒绝沿用。
+    # identity是source_identity(source)，与记录不同（源文件被修改过或没有文件标识）时返回None，重新准备
+    def lookup(self, index, sheet_name, cell_address, source, identity):
+        entry = self.entries.get(index)
+        if entry is None:
+            return None
+        if (entry['sheet'], entry['cell'], entry['source']) != (sheet_name, cell_address, source_name(source)):
+            raise CheckpointError(
+                f"检查点 {self.directory} 中第 {index + 1} 张图片与本次输入不一致"
+                f"（{entry['source']} -> {source_name(source)}），请换一个目录或删除后重新运行"
+            )
+        if identity is None or entry.get('identity') != identity:
+            return None
+        return entry
+
+    # 记录一张已写入输出包的图片，identity是源文件标识，assigned是 (media文件名, 图片ID, 关系ID)
+    def record(self, index, sheet_name, cell_address, prepared, identity, assigned):
+        media_name, image_id, r_id = assigned
+        entry = {
+            'index': index, 'sheet': sheet_name, 'cell': cell_address, 'source': prepared.source,
+            'identity': identity,
+            'digest': prepared.digest, 'extension': prepared.extension, 'size': len(prepared.data),
+            'width': prepared.width, 'height': prepared.height,
+            'media': media_name, 'id': image_id, 'rid': r_id,
+        }
+        self.entries[index] = entry
+        self._write(entry)
+
+    def close(self):
+        self._file.close()
+
+    # 构建成功后删除日志和检查点中的图片，目录为空时一并删除
+    def discard(self):
+        self.close()
+        os.remove(self.path)
+        shutil.rmtree(self.media_dir, ignore_errors=True)
+        with contextlib.suppress(OSError):
+            os.rmdir(self.directory)
+
+
+# 图片写入输出包时每次写入的块大小
+MEDIA_CHUNK_SIZE = 1024 * 1024
+
+# 工作表XML按块读取的大小
+SHEET_CHUNK_SIZE = 1024 * 1024
+
+# 流式改写工作表XML用到的模式（元素可以带命名空间前缀，如x:row）
+SHEET_DATA_PATTERN = re.compile(rb'<([\w.-]+:)?sheetData[\s/>]')
+ROW_OR_SHEET_DATA_END_PATTERN = re.compile(rb'<([\w.-]+:)?row[\s/>]|</(?:[\w.-]+:)?sheetData\s*>')
+CELL_OR_ROW_END_PATTERN = re.compile(rb'<(?:[\w.-]+:)?c[\s/>]|</(?:[\w.-]+:)?row\s*>')
+DIMENSION_PATTERN = re.compile(rb'<([\w.-]+:)?dimension\s[^>]*?(/?)>')
+COLS_PATTERN = re.compile(
+    rb'<([\w.-]+:)?cols\s*>(.*?)</(?:[\w.-]+:)?cols\s*>|<([\w.-]+:)?cols\s*/>', re.S
+)
+COL_PATTERN = re.compile(rb'<(?:[\w.-]+:)?col\s[^>]*>')
+FORMULA_PATTERN = re.compile(rb'<(?:[\w.-]+:)?f\s[^>]*>')
+ATTRIBUTE_PATTERN = re.compile(rb'([\w:.-]+)\s*=\s*("[^"]*"|\'[^\']*\')')
+
+
+# 解析开始标签中的属性，返回 [(名称, 带引号的值)]，保持原有顺序和引号
+def _tag_attributes(tag):
+    return ATTRIBUTE_PATTERN.findall(tag)
+
+
+def _attribute(attributes, name):
+    for key, value in attributes:
+        if key == name:
+            return value[1:-1].decode('utf-8')
+    return None
+
+
+def _start_tag(prefix, name, attributes, close=b'>'):
+    return b'<' + prefix + name + b''.join(b' %s=%s' % item for item in attributes) + close
+
+
+# 已有工作簿中要修改的内容无法安全改写
+class WorkbookError(ValueError):
+    pass
+
+
+# 工作表部件
+# 只保存 (行号, 列号) -> 图片ID 的查找表，不加载工作表XML；
+# 保存时由_SheetRewriter对原工作表XML做一次顺序扫描并直接写入输出包，
+# 内存占用只和图片数量有关，与工作表中已有单元格的数量无关
+class WorksheetPart:
+    def __init__(self, part_name, open_source, source_size=0):
+        self.part_name = part_name
+        self.open_source = open_source
+        self.source_size = source_size
+        self.images = {}
+
+    # 把单元格公式指向图片
+    def set_image(self, cell_address, image_id):
+        self.images[cell_to_rowcol(cell_address)] = image_id
+
+    # 按块读取原工作表XML，改写后写入dst
+    def write(self, dst, column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT):
+        with self.open_source() as src:
+            _SheetRewriter(src, dst, self.images, column_width, row_height).run()
+
+
+# 工作表XML的流式改写，一次顺序扫描完成：
+#   - dimension扩展到包含图片单元格，cols中为还没有列宽定义的图片列添加<col>
+#   - 包含图片的行设置行高、去掉spans，行内的图片单元格按列号替换或插入
+#   - 工作表中还没有的图片行按行号插入
+#   - 最后一个图片行之后的内容整块原样复制
+# 不包含图片的行不解析单元格，只查找行的结束位置后原样写出
+class _SheetRewriter:
+    def __init__(self, src, dst, images, column_width, row_height):
+        self.src = src
+        self.dst = dst
+        self.buf = b''
+        self.pos = 0
+        # buf[mark:pos]是已经扫描过、等待原样写出的内容，攒成一整块再写，减少写入次数
+        self.mark = 0
+        self.eof = False
+        self.column_width = column_width
+        self.row_height = str(row_height).encode('ascii')
+        self.prefix = b''
+
+        # 行号（从1开始） -> [(列号, 图片ID)]，按列号排序
+        self.rows = {}
+        for (row_index, col_index), image_id in images.items():
+            self.rows.setdefault(row_index + 1, []).append((col_index, image_id))
+        for cells in self.rows.values():
+            cells.sort()
+        self.pending_rows = deque(sorted(self.rows))
+        self.columns = sorted({col for _, col in images})
+
+    # 写出等待原样写出的内容，丢弃已经处理的部分，再读入一块
+    def _fill(self):
+        self._flush()
+        chunk = self.src.read(SHEET_CHUNK_SIZE)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = self.mark = 0
+        if not chunk:
+            self.eof = True
+
+    # 从当前位置向后查找，返回 (相对当前位置的偏移, match)，找不到时返回 (-1, None)
+    def _search(self, pattern):
+        start = 0
+        while True:
+            match = pattern.search(self.buf, self.pos + start)
+            if match is not None and (match.end() < len(self.buf) or self.eof):
+                return match.start() - self.pos, match
+            if self.eof:
+                return -1, None
+            # 只重新扫描末尾可能被截断的部分
+            start = max(0, len(self.buf) - self.pos - 64)
+            self._fill()
+
+    def _find(self, sub, start=0):
+        while True:
+            index = self.buf.find(sub, self.pos + start)
+            if index >= 0:
+                return index - self.pos
+            if self.eof:
+                return -1
+            start = max(0, len(self.buf) - self.pos - len(sub) + 1)
+            self._fill()
+
+    # 当前位置的元素（开始标签从当前位置开始）的长度，以及开始标签和是否自闭合
+    def _element(self, prefix, name):
+        tag_end = self._find(b'>')
+        if tag_end < 0:
+            raise ValueError("工作表XML不完整")
+        start_tag = self.buf[self.pos:self.pos + tag_end + 1]
+        if start_tag.endswith(b'/>'):
+            return tag_end + 1, start_tag, True
+        end_tag = b'</' + prefix + name + b'>'
+        close = self._find(end_tag, tag_end + 1)
+        if close < 0:
+            raise ValueError(f"工作表XML不完整，缺少{end_tag.decode('utf-8')}")
+        return close + len(end_tag), start_tag, False
+
+    def _flush(self):
+        if self.pos > self.mark:
+            self.dst.write(self.buf[self.mark:self.pos])
+        self.mark = self.pos
+
+    def _write(self, data):
+        self._flush()
+        self.dst.write(data)
+
+    # 原样写出接下来的size个字节
+    def _copy(self, size):
+        self.pos += size
+
+    # 丢弃接下来的size个字节
+    def _skip(self, size):
+        self._flush()
+        self.pos += size
+        self.mark = self.pos
+
+    def _copy_rest(self):
+        self.pos = len(self.buf)
+        self._flush()
+        shutil.copyfileobj(self.src, self.dst, SHEET_CHUNK_SIZE)
+
+    def run(self):
+        offset, match = self._search(SHEET_DATA_PATTERN)
+        if match is None:
+            raise ValueError("工作表XML中缺少sheetData")
+        self.prefix = match.group(1) or b''
+        header = self.buf[self.pos:self.pos + offset]
+        self._skip(offset)
+        self._write(self._rewrite_header(header))
+
+        # 只读取sheetData的开始标签
+        tag_end = self._find(b'>')
+        if tag_end < 0:
+            raise ValueError("工作表XML不完整")
+        start_tag = self.buf[self.pos:self.pos + tag_end + 1]
+        if start_tag.endswith(b'/>'):
+            # <sheetData/>：展开后写入全部图片行
+            self._skip(len(start_tag))
+            self._write(start_tag[:-2].rstrip() + b'>')
+            while self.pending_rows:
+                self._write_new_row(self.pending_rows.popleft())
+            self._write(b'</' + self.prefix + b'sheetData>')
+        else:
+            self._copy(len(start_tag))
+            self._rewrite_rows()
+        self._copy_rest()
+
+    # sheetData之前的部分：dimension和cols
+    def _rewrite_header(self, header):
+        header = DIMENSION_PATTERN.sub(self._rewrite_dimension, header, count=1)
+
+        match = COLS_PATTERN.search(header)
+        col_tags = COL_PATTERN.findall(match.group(2) or b'') if match else []
+        defined = []
+        for tag in col_tags:
+            attributes = _tag_attributes(tag)
+            defined.append((int(_attribute(attributes, b'min')), int(_attribute(attributes, b'max'))))
+
+        # 还没有列宽定义的图片列，相邻列合并为一个范围
+        ranges = []
+        for column in (c + 1 for c in self.columns):
+            if any(low <= column <= high for low, high in defined):
+                continue
+            if ranges and ranges[-1][1] == column - 1:
+                ranges[-1][1] = column
+            else:
+                ranges.append([column, column])
+        if not ranges:
+            return header
+
+        prefix = (match.group(1) or match.group(3) or b'') if match else self.prefix
+        width = str(self.column_width).encode('ascii')
+        for low, high in ranges:
+            col_tags.append(b'<%scol min="%d" max="%d" width="%s" customWidth="1"/>'
+                            % (prefix, low, high, width))
+        col_tags.sort(key=lambda tag: int(_attribute(_tag_attributes(tag), b'min')))
+        cols = b'<' + prefix + b'cols>' + b''.join(col_tags) + b'</' + prefix + b'cols>'
+        if match is None:
+            # cols位于sheetData之前
+            return header + cols
+        return header[:match.start()] + cols + header[match.end():]
+
+    # dimension的范围扩展到包含全部图片单元格
+    def _rewrite_dimension(self, match):
+        attributes = _tag_attributes(match.group(0))
+        ref = _attribute(attributes, b'ref')
+        if not self.rows or ref is None:
+            return match.group(0)
+
+        first_row, last_row = min(self.rows) - 1, max(self.rows) - 1
+        first_col, last_col = self.columns[0], self.columns[-1]
+        try:
+            corners = [cell_to_rowcol(address) for address in ref.split(':')]
+        except ValueError:
+            corners = []
+        for row_index, col_index in corners:
+            first_row, last_row = min(first_row, row_index), max(last_row, row_index)
+            first_col, last_col = min(first_col, col_index), max(last_col, col_index)
+
+        first = rowcol_to_cell(first_row, first_col)
+        last = rowcol_to_cell(last_row, last_col)
+        ref = first if first == last else f'{first}:{last}'
+        attributes = [
+            (key, b'"%s"' % ref.encode('ascii') if key == b'ref' else value)
+            for key, value in attributes
+        ]
+        return _start_tag(match.group(1) or b'', b'dimension', attributes, match.group(2) + b'>')
+
+    def _rewrite_rows(self):
+        last_row = 0
+        while self.pending_rows:
+            offset, match = self._search(ROW_OR_SHEET_DATA_END_PATTERN)
+            if match is None:
+                raise ValueError("工作表XML不完整，缺少sheetData结束标签")
+            self._copy(offset)
+            if match.group(0).startswith(b'</'):
+                break
+
+            prefix = match.group(1) or b''
+            size, start_tag, empty = self._element(prefix, b'row')
+            attributes = _tag_attributes(start_tag)
+            row_number = int(_attribute(attributes, b'r') or last_row + 1)
+            last_row = row_number
+
+            # 排在这一行之前的图片行
+            while self.pending_rows and self.pending_rows[0] < row_number:
+                self._write_new_row(self.pending_rows.popleft())
+
+            if self.pending_rows and self.pending_rows[0] == row_number:
+                self.pending_rows.popleft()
+                self._skip(len(start_tag))
+                self._rewrite_row(prefix, row_number, attributes, empty)
+            else:
+                self._copy(size)
+
+        # 剩余的图片行位于工作表末尾
+        while self.pending_rows:
+            self._write_new_row(self.pending_rows.popleft())
+
+    # 包含图片的行：设置行高，在单元格之间按列号替换或插入图片单元格
+    def _rewrite_row(self, prefix, row_number, attributes, empty):
+        # 新增的单元格使原来的spans不再准确，spans是可选属性，直接去掉
+        attributes = [(key, value) for key, value in attributes if key != b'spans']
+        if _attribute(attributes, b'customHeight') != '1':
+            attributes = [
+                (key, value) for key, value in attributes if key not in (b'ht', b'customHeight')
+            ]
+            attributes += [(b'ht', b'"%s"' % self.row_height), (b'customHeight', b'"1"')]
+        self._write(_start_tag(prefix, b'row', attributes))
+
+        images = deque(self.rows[row_number])
+        last_col = -1
+        while not empty:
+            offset, match = self._search(CELL_OR_ROW_END_PATTERN)
+            if match is None:
+                raise ValueError(f"工作表XML不完整，第{row_number}行缺少结束标签")
+            self._copy(offset)
+            if match.group(0).startswith(b'</'):
+                self._skip(len(match.group(0)))
+                break
+
+            size, start_tag, _ = self._element(prefix, b'c')
+            cell_attributes = _tag_attributes(start_tag)
+            ref = _attribute(cell_attributes, b'r')
+            col_index = cell_to_rowcol(ref)[1] if ref else last_col + 1
+            last_col = col_index
+
+            while images and images[0][0] < col_index:
+                self._write(self._image_cell(prefix, row_number, *images.popleft()))
+            if images and images[0][0] == col_index:
+                # 替换原有单元格，保留样式等属性
+                self._check_replaceable(self.buf[self.pos:self.pos + size], row_number, col_index)
+                self._skip(size)
+                self._write(self._image_cell(prefix, row_number, *images.popleft(), cell_attributes))
+            else:
+                self._copy(size)
+
+        while images:
+            self._write(self._image_cell(prefix, row_number, *images.popleft()))
+        self._write(b'</' + prefix + b'row>')
+
+    # 共享公式的主单元格（f元素带ref，范围内还有其他单元格）保存着其他单元格共用的公式，
+    # 替换后这些单元格的公式会失效，拒绝替换而不是生成损坏的工作簿。
+    # 图片单元格自身的共享公式只包含自己，可以替换
+    def _check_replaceable(self, cell, row_number, col_index):
+        match = FORMULA_PATTERN.search(cell)
+        if match is None:
+            return
+        attributes = _tag_attributes(match.group(0))
+        ref = _attribute(attributes, b'ref')
+        if _attribute(attributes, b't') != 'shared' or not ref:
+            return
+        cell_address = rowcol_to_cell(row_number - 1, col_index)
+        if set(ref.split(':')) != {cell_address}:
+            raise WorkbookError(
+                f"单元格 {cell_address} 是共享公式（{ref}）的主单元格，替换为图片会使其他单元格的公式失效，"
+                f"请换一个单元格或先把这些公式转换为普通公式"
+            )
+
+    # 工作表中还没有的图片行
+    def _write_new_row(self, row_number):
+        prefix = self.prefix
+        self._write(b'<%srow r="%d" ht="%s" customHeight="1">' % (prefix, row_number, self.row_height))
+        for col_index, image_id in self.rows[row_number]:
+            self._write(self._image_cell(prefix, row_number, col_index, image_id))
+        self._write(b'</' + prefix + b'row>')
+
+    # 图片单元格：类型为str（与正常文件保持一致），f元素是DISPIMG公式，
+    # v元素是公式本身
+    def _image_cell(self, prefix, row_number, col_index, image_id, attributes=()):
+        cell_address = rowcol_to_cell(row_number - 1, col_index).encode('ascii')
+        attributes = (
+            [(b'r', b'"%s"' % cell_address)]
+            + [(key, value) for key, value in attributes if key not in (b'r', b't')]
+            + [(b't', b'"str"')]
+        )
+        image_id = image_id.encode('utf-8')
+        return (
+            _start_tag(prefix, b'c', attributes)
+            + b'<%sf t="shared" ref="%s">_xlfn.DISPIMG("%s",1)</%sf>'
+            % (prefix, cell_address, image_id, prefix)
+            + b'<%sv>=DISPIMG("%s",1)</%sv></%sc>' % (prefix, image_id, prefix, prefix)
+        )
+
+
+# 包内唯一ID的分配器
+# 从已有部件中只扫描一次，之后每次分配都是O(1)：
+#   - 每个关系部件各自的rId序列（cellimages.xml.rels、workbook.xml.rels）
+#   - cellimages.xml中xdr:cNvPr的id，每张图片各不相同
+#   - DISPIMG的ID_名称和media文件名，与已有名称冲突时重新生成并计数
+# 所有方法都加锁，可以在多个工作线程中同时调用
+class IdAllocator:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_r_ids = {}
+        self._next_shape_id = 2
+        self._names = set()
+        self.collisions = 0
+
+    # 记录关系部件中已有的rId，之后从最大值的下一个开始分配
+    def seed_r_ids(self, scope, r_ids):
+        nums = [0]
+        for r_id in r_ids:
+            if r_id and r_id.startswith('rId') and r_id[3:].isdigit():
+                nums.append(int(r_id[3:]))
+        with self._lock:
+            self._next_r_ids[scope] = max(max(nums) + 1, self._next_r_ids.get(scope, 1))
+
+    def next_r_id(self, scope):
+        with self._lock:
+            num = self._next_r_ids.get(scope, 1)
+            self._next_r_ids[scope] = num + 1
+        return f'rId{num}'
+
+    # 记录已有的cNvPr id
+    def seed_shape_ids(self, shape_ids):
+        nums = [int(shape_id) for shape_id in shape_ids if shape_id and shape_id.isdigit()]
+        with self._lock:
+            self._next_shape_id = max(self._next_shape_id, max(nums, default=0) + 1)
+
+    def next_shape_id(self):
+        with self._lock:
+            shape_id = self._next_shape_id
+            self._next_shape_id += 1
+        return shape_id
+
+    # 记录已经使用的名称（已有的图片ID、media文件名）
+    def seed_names(self, names):
+        with self._lock:
+            self._names.update(names)
+
+    # 生成未使用过的名称：prefix + 随机十六进制 + suffix
+    def new_name(self, prefix, suffix=''):
+        while True:
+            name = f'{prefix}{uuid.uuid4().hex}{suffix}'
+            with self._lock:
+                if name not in self._names:
+                    self._names.add(name)
+                    return name
+                self.collisions += 1
+
+
+# 新增cellImage和图片关系的XML片段模板。结构固定，只有cNvPr id、图片ID、rId和尺寸不同，
+# 直接按模板格式化为字符串，不再为每张图片逐个构造二十几个lxml元素；
+# 包模型按根元素已声明的命名空间在开始标签中补上缺少的声明（见_fragment_template）
+CELL_IMAGE_TEMPLATE = (
+    '  <etc:cellImage><xdr:pic>'
+    '<xdr:nvPicPr><xdr:cNvPr id="%d" name="%s"/>'
+    '<xdr:cNvPicPr><a:picLocks noChangeAspect="1"/></xdr:cNvPicPr></xdr:nvPicPr>'
+    '<xdr:blipFill><a:blip r:embed="%s"/><a:stretch><a:fillRect/></a:stretch></xdr:blipFill>'
+    '<xdr:spPr><a:xfrm><a:off x="0" y="0"/><a:ext cx="%d" cy="%d"/></a:xfrm>'
+    '<a:prstGeom prst="rect"><a:avLst/></a:prstGeom><a:noFill/><a:ln w="9525"><a:noFill/></a:ln>'
+    '</xdr:spPr></xdr:pic></etc:cellImage>\n'
+)
+CELL_IMAGE_NAMESPACES = (('etc', NS_ETC), ('xdr', NS_XDR), ('a', NS_A), ('r', NS_R))
+IMAGE_REL_TEMPLATE = f'  <Relationship Id="%s" Type="{REL_TYPE_IMAGE}" Target="media/%s"/>\n'
+IMAGE_REL_NAMESPACES = ((None, NS_REL),)
+
+# 片段按批拼接、编码后写入输出流
+FRAGMENT_BATCH_SIZE = 1024
+
+# 序列化后根元素的结束标签（没有子元素时是自闭合标签）
+ROOT_END_PATTERN = re.compile(rb'(/>|</[^<>]+>)\s*$')
+
+
+# 转义属性值中的XML特殊字符
+def escape_attribute(value):
+    return (value.replace('&', '&amp;').replace('<', '&lt;')
+            .replace('>', '&gt;').replace('"', '&quot;'))
+
+
+# 序列化部件，并在根元素的结束标签前插入新片段：已有内容由lxml序列化，
+# 新片段按批直接写入输出流
+def write_with_fragments(f, tree, fragments):
+    data = etree.tostring(tree, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+    match = ROOT_END_PATTERN.search(data)
+    if match.group(1) == b'/>':
+        root = tree.getroot()
+        name = etree.QName(root).localname
+        qname = f'{root.prefix}:{name}' if root.prefix else name
+        head, tail = data[:match.start()] + b'>\n', f'</{qname}>\n'.encode('utf-8')
+    else:
+        head, tail = data[:match.start()], data[match.start():]
+    f.write(head)
+    for i in range(0, len(fragments), FRAGMENT_BATCH_SIZE):
+        f.write(''.join(fragments[i:i + FRAGMENT_BATCH_SIZE]).encode('utf-8'))
+    f.write(tail)
+
+
+# 当前进程（children为True时是已结束的子进程中最大的）的峰值RSS，单位字节；不支持的平台返回None
+def peak_rss(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # macOS上ru_maxrss的单位是字节，Linux上是KB
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+# 流水线的分阶段统计：每个阶段的耗时、读写字节数、次数和阶段结束时的峰值RSS。
+# 阶段依次为 base（生成基础文件）、load（加载部件）、prepare（工作池中准备图片，耗时是各任务之和）、
+# prepare_wait（写入阶段等待准备结果）、write（写入图片）、copy（复制未修改的成员）、
+# xml_parts（写入修改过的XML部件）、worksheets（流式改写工作表）和 finalize（写入ZIP目录）。
+# per_image为True时另外记录每张图片的明细；启用了tracemalloc时同时记录每个阶段的Python内存分配峰值。
+# 只在写入阶段所在的线程中更新，不需要加锁
+class PipelineStats:
+    def __init__(self, per_image=False):
+        self.stages = {}
+        self.images = [] if per_image else None
+        # 分片输出时各分片的报告（分片在工作进程中生成，统计随结果返回）
+        self.shards = None
+        # 跳过的图片和检查点恢复情况
+        self.failures = []
+        self.checkpoint = None
+        self.start = time.perf_counter()
+
+    def _stage(self, name):
+        stage = self.stages.get(name)
+        if stage is None:
+            stage = self.stages[name] = {
+                'seconds': 0.0, 'calls': 0, 'bytes_read': 0, 'bytes_written': 0,
+            }
+        return stage
+
+    def add(self, name, seconds, bytes_read=0, bytes_written=0):
+        stage = self._stage(name)
+        stage['seconds'] += seconds
+        stage['calls'] += 1
+        stage['bytes_read'] += bytes_read
+        stage['bytes_written'] += bytes_written
+        return stage
+
+    # 记录阶段结束时的峰值RSS和tracemalloc峰值
+    def mark(self, name):
+        stage = self._stage(name)
+        stage['peak_rss'] = peak_rss()
+        tracemalloc = sys.modules.get('tracemalloc')
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            stage['traced_peak'] = max(stage.get('traced_peak', 0), tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        return stage
+
+    # 计时一个阶段；position是返回当前输出位置的函数，用于统计写入的字节数
+    @contextlib.contextmanager
+    def measure(self, name, position=None):
+        tracemalloc = sys.modules.get('tracemalloc')
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        start_position = position() if position is not None else 0
+        start = time.perf_counter()
+        stage = self._stage(name)
+        try:
+            yield stage
+        finally:
+            stage['seconds'] += time.perf_counter() - start
+            stage['calls'] += 1
+            if position is not None:
+                stage['bytes_written'] += position() - start_position
+            self.mark(name)
+
+    # 记录一张图片：准备（在工作池中）、等待和写入的耗时，以及读写的字节数
+    def add_image(self, sheet_name, cell_address, prepared, wait, write, bytes_written, duplicate):
+        self.add('prepare', prepared.elapsed, prepared.source_size, len(prepared.data))
+        self.add('prepare_wait', wait)
+        self.add('write', write, bytes_written=bytes_written)
+        if self.images is not None:
+            self.images.append({
+                'sheet': sheet_name, 'cell': cell_address, 'source': prepared.source,
+                'bytes_read': prepared.source_size, 'bytes_prepared': len(prepared.data),
+                'bytes_written': bytes_written, 'prepare_seconds': prepared.elapsed,
+                'wait_seconds': wait, 'write_seconds': write,
+                'cached': prepared.cached, 'duplicate': duplicate, 'peak_rss': peak_rss(),
+            })
+
+    # 可以直接序列化为JSON的报告
+    def report(self):
+        report = {
+            'elapsed': time.perf_counter() - self.start,
+            'peak_rss': peak_rss(),
+            'children_peak_rss': peak_rss(children=True),
+            'stages': self.stages,
+        }
+        if self.images is not None:
+            report['images'] = self.images
+        if self.shards is not None:
+            report['shards'] = self.shards
+        if self.failures:
+            report['failures'] = self.failures
+        if self.checkpoint is not None:
+            report['checkpoint'] = self.checkpoint
+        return report
+
+
+# 把报告中的阶段统计格式化为表格行（字节数以MB为单位）
+def format_stages(report):
+    # 表头中的汉字占两列宽，按显示宽度对齐
+    lines = ['阶段' + ' ' * 10 + '    耗时(秒)' + '      次数' + '    读取(MB)' + '    写入(MB)' + '   峰值RSS(MB)']
+    for name, stage in report['stages'].items():
+        rss = stage.get('peak_rss')
+        lines.append(
+            f"{name:<14}{stage['seconds']:>12.3f}{stage['calls']:>10}"
+            f"{stage['bytes_read'] / 1024 ** 2:>12.1f}{stage['bytes_written'] / 1024 ** 2:>12.1f}"
+            f"{rss / 1024 ** 2 if rss else '-':>14{'.1f' if rss else ''}}"
+        )
+    return lines
+
+
+# 步骤2: 内存中的包模型，直接从基础包流式写入输出包
+# 一次性加载[Content_Types].xml、workbook.xml、workbook.xml.rels、cellimages.xml和
+# cellimages.xml.rels，在内存中收集全部插入，最后每个部件只写一次；
+# 工作表XML不加载，保存时流式改写，
+# 这样处理N张图片的开销是线性的，而不是每张图片都重新解析和写回整个文件。
+# 未修改的成员直接从基础包复制到输出包，图片直接写入输出包，中间不经过磁盘解压
+class CellImagePackage:
+    def __init__(self, base_zip, output_zip, profile=DEFAULT_PROFILE, xml_level=None,
+                 column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT, stats=None):
+        self.base_zip = base_zip
+        self.output_zip = output_zip
+        self.stats = stats if stats is not None else PipelineStats()
+        self.bytes_loaded = 0
+        self.profile = profile
+        self.xml_level = xml_level
+        self.column_width = column_width
+        self.row_height = row_height
+        self.parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
+
+        self.content_types = self._load('[Content_Types].xml')
+        self.workbook = self._load('xl/workbook.xml')
+        self.workbook_rels = self._load('xl/_rels/workbook.xml.rels')
+        self.cellimages = self._load('xl/cellimages.xml', lambda: etree.Element(
+            f'{{{NS_ETC}}}cellImages',
+            nsmap={'xdr': NS_XDR, 'r': NS_R, 'a': NS_A, 'etc': NS_ETC}
+        ))
+        self.cellimages_rels = self._load('xl/_rels/cellimages.xml.rels', lambda: etree.Element(
+            f'{{{NS_REL}}}Relationships', nsmap={None: NS_REL}
+        ))
+
+        # 工作表名 -> 部件名，用到的工作表记录图片单元格，保存时流式改写
+        self.sheet_parts = self._read_sheet_parts()
+        self.worksheets = {}
+
+        # 已有的rId、cNvPr id、图片ID和media文件名只扫描一次，之后由分配器递增分配
+        self.ids = IdAllocator()
+        self._seed_ids()
+
+        # 已注册Default内容类型的扩展名（不区分大小写）
+        self._extensions = {
+            default.get('Extension', '').lower()
+            for default in self.content_types.getroot().iterfind(f'{{{NS_CT}}}Default')
+        }
+
+        # 新增图片的cellImage和关系片段，保存时插入到已有内容之后
+        self.cell_image_fragments = []
+        self.image_rel_fragments = []
+        self._cell_image_template = self._fragment_template(
+            CELL_IMAGE_TEMPLATE, self.cellimages, CELL_IMAGE_NAMESPACES
+        )
+        self._image_rel_template = self._fragment_template(
+            IMAGE_REL_TEMPLATE, self.cellimages_rels, IMAGE_REL_NAMESPACES
+        )
+
+        # 内容哈希 -> (图片ID, rId)，用于相同图片去重
+        self.images_by_hash = {}
+        self.image_count = 0
+        self.bytes_saved = 0
+
+        self._register_cellimages_part()
+
+    def _load(self, part_name, create_root=None):
+        try:
+            data = self.base_zip.read(part_name)
+        except KeyError:
+            if create_root is None:
+                raise FileNotFoundError(f"Excel包中缺少部件: {part_name}")
+            return etree.ElementTree(create_root())
+        self.bytes_loaded += len(data)
+        return etree.ElementTree(etree.fromstring(data, self.parser))
+
+    # 片段模板使用固定的命名空间前缀；根元素没有用相同前缀声明这些命名空间时
+    # （例如其他程序生成的cellimages.xml），在片段的开始标签中补上声明
+    @staticmethod
+    def _fragment_template(template, tree, namespaces):
+        nsmap = tree.getroot().nsmap
+        declarations = ''.join(
+            f' xmlns:{prefix}="{uri}"' if prefix else f' xmlns="{uri}"'
+            for prefix, uri in namespaces if nsmap.get(prefix) != uri
+        )
+        if not declarations:
+            return template
+        # 插入到第一个开始标签的末尾（自闭合标签的/>之前）
+        tag_end = template.index('>')
+        if template[tag_end - 1] == '/':
+            tag_end -= 1
+        return template[:tag_end] + declarations.replace('%', '%%') + template[tag_end:]
+
+    def _modified_parts(self):
+        parts = {
+            '[Content_Types].xml': self.content_types,
+            'xl/workbook.xml': self.workbook,
+            'xl/_rels/workbook.xml.rels': self.workbook_rels,
+            'xl/cellimages.xml': self.cellimages,
+            'xl/_rels/cellimages.xml.rels': self.cellimages_rels,
+        }
+        return parts
+
+    # 未修改的成员按原始压缩数据直接复制到输出包，不解压也不重新压缩，
+    # 追加到大型工作簿时，已有的图片和工作表只是顺序复制字节
+    # 返回复制的压缩字节数
+    def _copy_unchanged_members(self, modified):
+        copied = 0
+        for info in self.base_zip.infolist():
+            if info.filename in modified or info.is_dir():
+                continue
+            copy_raw_member(self.base_zip, self.output_zip, info)
+            copied += info.compress_size
+        return copied
+
+    # 输出包当前写到的位置，用于统计各阶段写入的字节数
+    def output_position(self):
+        return self.output_zip.fp.tell()
+
+    # 从workbook.xml和workbook.xml.rels解析 工作表名 -> 工作表部件名（按工作簿中的顺序）
+    def _read_sheet_parts(self):
+        targets = {
+            rel.get('Id'): rel.get('Target')
+            for rel in self.workbook_rels.getroot().iter(f'{{{NS_REL}}}Relationship')
+        }
+        sheet_parts = {}
+        for sheet in self.workbook.getroot().iter(f'{{{NS_MAIN}}}sheet'):
+            target = targets.get(sheet.get(f'{{{NS_R}}}id'))
+            if target is None:
+                continue
+            if target.startswith('/'):
+                part_name = target.lstrip('/')
+            else:
+                part_name = posixpath.normpath(posixpath.join('xl', target))
+            sheet_parts[sheet.get('name')] = part_name
+        return sheet_parts
+
+    def _seed_ids(self):
+        root = self.cellimages.getroot()
+        # cellimages.xml.rels中的关系，也检查cellimages.xml中的r:embed
+        self.ids.seed_r_ids('cellimages', itertools.chain(
+            (rel.get('Id') for rel in self.cellimages_rels.getroot().iter(f'{{{NS_REL}}}Relationship')),
+            (blip.get(f'{{{NS_R}}}embed') for blip in root.iter(f'{{{NS_A}}}blip')),
+        ))
+        self.ids.seed_r_ids('workbook', (
+            rel.get('Id') for rel in self.workbook_rels.getroot().iter(f'{{{NS_REL}}}Relationship')
+        ))
+        c_nv_prs = list(root.iter(f'{{{NS_XDR}}}cNvPr'))
+        self.ids.seed_shape_ids(c_nv_pr.get('id') for c_nv_pr in c_nv_prs)
+        self.ids.seed_names(c_nv_pr.get('name') for c_nv_pr in c_nv_prs)
+        self.ids.seed_names(
+            posixpath.basename(name) for name in self.base_zip.namelist()
+            if name.startswith('xl/media/')
+        )
+
+    # 注册cellimages.xml的内容类型和workbook关系
+    def _register_cellimages_part(self):
+        root = self.content_types.getroot()
+        if root.find(f'{{{NS_CT}}}Override[@PartName="/xl/cellimages.xml"]') is None:
+            etree.SubElement(
+                root, f'{{{NS_CT}}}Override',
+                PartName='/xl/cellimages.xml', ContentType=CELLIMAGES_CONTENT_TYPE
+            )
+
+        root = self.workbook_rels.getroot()
+        registered = any(
+            rel.get('Type') == REL_TYPE_CELLIMAGE
+            or rel.get('Target', '').lstrip('/') in ('cellimages.xml', 'xl/cellimages.xml')
+            for rel in root.iter(f'{{{NS_REL}}}Relationship')
+        )
+        if not registered:
+            etree.SubElement(
+                root, f'{{{NS_REL}}}Relationship',
+                Id=self.ids.next_r_id('workbook'), Type=REL_TYPE_CELLIMAGE, Target='cellimages.xml'
+            )
+
+    # 确保图片扩展名在[Content_Types].xml中有Default内容类型
+    def _register_extension(self, extension):
+        extension = extension.lower()
+        if extension in self._extensions:
+            return
+        etree.SubElement(
+            self.content_types.getroot(), f'{{{NS_CT}}}Default',
+            Extension=extension,
+            ContentType=IMAGE_CONTENT_TYPES.get(extension, f'image/{extension}')
+        )
+        self._extensions.add(extension)
+
+    # 按名称获取工作表，不存在时新建；sheet_name为None时使用第一个工作表
+    def worksheet(self, sheet_name=None):
+        if sheet_name is None:
+            if not self.sheet_parts:
+                raise ValueError("工作簿中没有工作表")
+            sheet_name = next(iter(self.sheet_parts))
+        elif sheet_name not in self.sheet_parts:
+            # 工作表名不区分大小写，已有工作簿中的工作表按原名称使用
+            for existing in self.sheet_parts:
+                if existing.lower() == sheet_name.lower():
+                    sheet_name = existing
+                    break
+
+        worksheet = self.worksheets.get(sheet_name)
+        if worksheet is not None:
+            return worksheet
+
+        part_name = self.sheet_parts.get(sheet_name)
+        if part_name is None:
+            part_name = self._add_sheet(sheet_name)
+            worksheet = WorksheetPart(part_name, lambda: io.BytesIO(EMPTY_WORKSHEET_XML))
+        else:
+            try:
+                info = self.base_zip.getinfo(part_name)
+            except KeyError:
+                raise FileNotFoundError(f"Excel包中缺少部件: {part_name}")
+            worksheet = WorksheetPart(
+                part_name, lambda: self.base_zip.open(info), info.file_size
+            )
+        self.worksheets[sheet_name] = worksheet
+        return worksheet
+
+    # 新建工作表：workbook.xml中的<sheet>、workbook关系和内容类型
+    def _add_sheet(self, sheet_name):
+        validate_sheet_name(sheet_name)
+        if sheet_name.lower() in (name.lower() for name in self.sheet_parts):
+            raise ValueError(f"工作表名重复: {sheet_name}")
+
+        existing = set(self.sheet_parts.values())
+        index = 1
+        while f'xl/worksheets/sheet{index}.xml' in existing:
+            index += 1
+        part_name = f'xl/worksheets/sheet{index}.xml'
+
+        r_id = self.ids.next_r_id('workbook')
+        etree.SubElement(
+            self.workbook_rels.getroot(), f'{{{NS_REL}}}Relationship',
+            Id=r_id, Type=REL_TYPE_WORKSHEET, Target=part_name[len('xl/'):]
+        )
+        etree.SubElement(
+            self.content_types.getroot(), f'{{{NS_CT}}}Override',
+            PartName=f'/{part_name}', ContentType=WORKSHEET_CONTENT_TYPE
+        )
+
+        root = self.workbook.getroot()
+        sheets = root.find(f'{{{NS_MAIN}}}sheets')
+        if sheets is None:
+            sheets = etree.SubElement(root, f'{{{NS_MAIN}}}sheets')
+        sheet_ids = [int(sheet.get('sheetId', 0)) for sheet in sheets]
+        etree.SubElement(
+            sheets, f'{{{NS_MAIN}}}sheet',
+            name=sheet_name, sheetId=str(max(sheet_ids, default=0) + 1),
+            **{f'{{{NS_R}}}id': r_id}
+        )
+
+        self.sheet_parts[sheet_name] = part_name
+        return part_name
+
+    # 图片数据按块写入输出包，mmap映射的大文件不需要先复制成一整块bytes
+    def _write_media(self, info, data):
+        info.file_size = len(data)
+        with self.output_zip.open(info, 'w') as dest, memoryview(data) as view:
+            for start in range(0, len(view), MEDIA_CHUNK_SIZE):
+                dest.write(view[start:start + MEDIA_CHUNK_SIZE])
+
+    # 添加一张图片：图片直接写入输出包的xl/media，
+    # 再添加cellImage节点、图片关系，并把单元格公式指向该图片。
+    # 内容相同的图片只保存一份，多个单元格共用同一个media成员、关系和DISPIMG ID
+    def add_image(self, source, cell_address, sheet_name=None):
+        prepared = prepare_image(source)
+        try:
+            return self.add_prepared(prepared, cell_address, sheet_name)
+        finally:
+            release_image_data(prepared.data)
+
+    # 写入阶段：把已经准备好的图片加入包中，只能按顺序单线程调用
+    # assigned是检查点中记录的 (media文件名, 图片ID, 关系ID)，重新组装时沿用，不重新分配
+    def add_prepared(self, prepared, cell_address, sheet_name=None, assigned=None):
+        worksheet = self.worksheet(sheet_name)
+        self.image_count += 1
+        if prepared.digest in self.images_by_hash:
+            image_id, r_id, _ = self.images_by_hash[prepared.digest]
+            self.bytes_saved += len(prepared.data)
+            worksheet.set_image(cell_address, image_id)
+            return image_id, r_id
+
+        if assigned is not None:
+            image_name, image_id, r_id = assigned
+        else:
+            # 生成唯一的图片文件名、图片ID和关系ID
+            image_name = self.ids.new_name('image_', prepared.extension)
+            image_id = self.ids.new_name('ID_')
+            r_id = self.ids.next_r_id('cellimages')
+        media_name = f'xl/media/{image_name}'
+        self._write_media(new_zip_info(media_name, self.profile, self.xml_level), prepared.data)
+        self.images_by_hash[prepared.digest] = (image_id, r_id, image_name)
+
+        self.cell_image_fragments.append(self._cell_image_template % (
+            self.ids.next_shape_id(), escape_attribute(image_id), escape_attribute(r_id),
+            prepared.width * EMU_PER_PIXEL, prepared.height * EMU_PER_PIXEL
+        ))
+        self.image_rel_fragments.append(
+            self._image_rel_template % (escape_attribute(r_id), escape_attribute(image_name))
+        )
+        self._register_extension(os.path.splitext(image_name)[1].lstrip('.'))
+
+        worksheet.set_image(cell_address, image_id)
+        return image_id, r_id
+
+    # 每个修改过的部件只写入输出包一次，其余成员从基础包原样复制
+    def save(self):
+        modified = self._modified_parts()
+        worksheets = {worksheet.part_name: worksheet for worksheet in self.worksheets.values()}
+        with self.stats.measure('copy', self.output_position) as stage:
+            stage['bytes_read'] += self._copy_unchanged_members(modified.keys() | worksheets.keys())
+        fragments = {
+            'xl/cellimages.xml': self.cell_image_fragments,
+            'xl/_rels/cellimages.xml.rels': self.image_rel_fragments,
+        }
+        with self.stats.measure('xml_parts', self.output_position):
+            for part_name, tree in modified.items():
+                info = new_zip_info(part_name, self.profile, self.xml_level)
+                with self.output_zip.open(info, 'w') as f:
+                    if fragments.get(part_name):
+                        write_with_fragments(f, tree, fragments[part_name])
+                    else:
+                        tree.write(f, pretty_print=True, xml_declaration=True, encoding='UTF-8')
+        with self.stats.measure('worksheets', self.output_position) as stage:
+            for part_name, worksheet in worksheets.items():
+                info = new_zip_info(part_name, self.profile, self.xml_level)
+                # 写入前不知道大小，超大的工作表需要ZIP64
+                force_zip64 = worksheet.source_size > zipfile.ZIP64_LIMIT // 2
+                with self.output_zip.open(info, 'w', force_zip64=force_zip64) as f:
+                    worksheet.write(f, self.column_width, self.row_height)
+                stage['bytes_read'] += worksheet.source_size
+        total = len(self.cellimages.getroot()) + len(self.cell_image_fragments)
+        logger.info(f"已写入cellimages.xml等部件，共 {total} 张图片")
+        if self.bytes_saved:
+            logger.info(f"相同图片去重: {self.image_count} 个单元格共用 {len(self.images_by_hash)} 张图片，"
+                        f"节省 {self.bytes_saved} 字节")
+        if self.ids.collisions:
+            logger.warning(f"有 {self.ids.collisions} 个新生成的名称与已有名称冲突，已重新生成")
+
+# 步骤3: 并行处理流水线
+# 图片的读取、哈希、尺寸探测、缓存查找和可选的缩放/重新编码在工作池中并发执行，
+# 结果按提交顺序交给唯一的写入阶段，保证单元格分配是确定的。
+# 同时在途的任务数有上限，避免所有图片字节同时驻留内存。
+# jobs是 (工作表名, 单元格地址, 图片源) 的可迭代对象，返回 (写入的图片数量, 耗时秒数, [ImageFailure])。
+# 传入executor时使用调用方的工作池（例如服务中多个请求共用一个有上限的线程池），否则新建一个。
+# journal是可选的BuildJournal：已记录的图片从检查点读取并沿用原来的ID，新写入的图片追加到日志；
+# skip_errors为True时跳过无法处理的图片（单元格留空），记录在返回的失败列表中，不中断整个批次
+def run_pipeline(package, jobs, workers=DEFAULT_WORKERS, use_processes=False, on_added=None,
+                 transform=None, cache=None, executor=None, journal=None, skip_errors=False):
+    own_executor = executor is None
+    if own_executor:
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        executor = executor_class(max_workers=max(1, workers))
+    max_pending = max(1, workers) * 4
+    pending = deque()
+    count = 0
+    failures = []
+    # 缓存只保存变换后的图片（见prepare_image），没有变换时不查找，也不计入命中统计
+    if transform is None:
+        cache = None
+    # 已经用过的文件对象（按对象标识）
+    file_sources = {}
+    start = time.perf_counter()
+
+    stats = package.stats
+    media_dir = None
+    if journal is not None:
+        media_dir = journal.media_dir
+        journal.reserve(package.ids)
+
+    def write_next():
+        nonlocal count
+        future, index, sheet_name, cell_address, entry, identity = pending.popleft()
+        wait_start = time.perf_counter()
+        prepared = future.result()
+        if isinstance(prepared, ImageFailure):
+            failure = prepared._replace(sheet=sheet_name, cell=cell_address)
+            logger.warning(f"⚠️ 跳过无法处理的图片 {failure.source}（单元格 {cell_address}）: {failure.error}")
+            failures.append(failure)
+            stats.failures.append(failure._asdict())
+            return
+
+        # 源文件没有变化、图片从检查点读取（或重新准备后内容相同）时沿用记录的ID
+        resumed = entry is not None and entry['digest'] == prepared.digest
+        assigned = (entry['media'], entry['id'], entry['rid']) if resumed else None
+        if cache is not None and entry is None:
+            cache.record(prepared.cached)
+        write_start = time.perf_counter()
+        position = package.output_position()
+        unique_images = len(package.images_by_hash)
+        image_id, r_id = package.add_prepared(prepared, cell_address, sheet_name, assigned)
+        stats.add_image(
+            sheet_name, cell_address, prepared, write_start - wait_start,
+            time.perf_counter() - write_start, package.output_position() - position,
+            len(package.images_by_hash) == unique_images
+        )
+        if journal is not None:
+            if resumed:
+                journal.resumed += 1
+            else:
+                media_name = package.images_by_hash[prepared.digest][2]
+                journal.record(
+                    index, sheet_name, cell_address, prepared, identity, (media_name, image_id, r_id)
+                )
+        count += 1
+        if on_added is not None:
+            on_added(sheet_name, cell_address, image_id, r_id)
+        release_image_data(prepared.data)
+
+    try:
+        for index, (sheet_name, cell_address, source) in enumerate(jobs):
+            if is_file_source(source):
+                # 文件对象读取一次就到了末尾，同一个对象用于多个单元格时直接报错，而不是得到空数据
+                if id(source) in file_sources:
+                    raise ValueError(
+                        f"同一个文件对象不能用于多个单元格（{cell_address}）: {source_name(source)}，"
+                        f"相同的图片请传入路径或bytes"
+                    )
+                file_sources[id(source)] = source
+            entry = identity = None
+            if journal is not None:
+                identity = source_identity(source)
+                entry = journal.lookup(index, sheet_name, cell_address, source, identity)
+            if use_processes and is_file_source(source):
+                # 文件对象不能传给工作进程，先在主进程中读取，保留显示名称
+                source = ImageSource(read_image_source(source), source_name(source))
+            future = executor.submit(
+                prepare_job, source, transform, cache, not use_processes, media_dir, entry, skip_errors
+            )
+            pending.append((future, index, sheet_name, cell_address, entry, identity))
+            if len(pending) >= max_pending:
+                write_next()
+        while pending:
+            write_next()
+    finally:
+        # 出错时取消还没开始的任务，共用的工作池不会继续处理这个请求的图片
+        for future, *_ in pending:
+            future.cancel()
+        if own_executor:
+            executor.shutdown()
+
+    stats.mark('prepare')
+    stats.mark('write')
+    if cache is not None:
+        cache.evict()
+    elapsed = time.perf_counter() - start
+    return count, elapsed, failures
+
+
+# 内嵌结果统计
+# report是PipelineStats.report()生成的分阶段统计，可以直接序列化为JSON；
+# failures是skip_errors时跳过的图片 [ImageFailure]
+EmbedResult = namedtuple(
+    'EmbedResult', 'count unique_images bytes_saved elapsed report failures', defaults=(None, ())
+)
+
+
+# 检查点中记录的文件标识：绝对路径、大小和修改时间，文件变化后旧的检查点不再沿用
+def file_identity(path):
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+# 以base_excel为基础包，把jobs中的图片写入output，出错时不留下不完整的输出文件。
+# checkpoint是可选的检查点目录（见BuildJournal），base_identity标识基础包的来源，和其他参数一起
+# 决定检查点能否沿用。构建成功且没有跳过的图片时删除检查点；有跳过的图片或构建失败时保留，
+# 修复后用相同的参数重新运行只处理剩下的图片
+def _build_workbook(base_excel, output, jobs, profile, workers, use_processes, transform, cache,
+                    column_width, row_height, on_added, executor=None, stats=None,
+                    checkpoint=None, base_identity=None, skip_errors=False, xml_level=None):
+    if stats is None:
+        stats = PipelineStats()
+    journal = None
+    if checkpoint is not None:
+        journal = BuildJournal(checkpoint, {
+            'base': base_identity, 'profile': profile, 'transform': transform,
+            'column_width': column_width, 'row_height': row_height,
+        })
+        if journal.entries:
+            logger.info(f"从检查点 {checkpoint} 恢复: {len(journal.entries)} 张图片已完成准备")
+    try:
+        with zipfile.ZipFile(base_excel, 'r') as base_zip, \
+                zipfile.ZipFile(output, 'w') as output_zip:
+            with stats.measure('load') as stage:
+                package = CellImagePackage(
+                    base_zip, output_zip, profile=profile, xml_level=xml_level,
+                    column_width=column_width, row_height=row_height, stats=stats
+                )
+                stage['bytes_read'] += package.bytes_loaded
+            count, elapsed, failures = run_pipeline(
+                package, jobs, workers, use_processes, on_added=on_added,
+                transform=transform, cache=cache, executor=executor,
+                journal=journal, skip_errors=skip_errors
+            )
+            package.save()
+            with stats.measure('finalize'):
+                output_zip.close()
+    except BaseException:
+        if isinstance(output, (str, os.PathLike)) and os.path.exists(output):
+            os.remove(output)
+        if journal is not None:
+            journal.close()
+            logger.error(f"构建中断，已完成的 {len(journal.entries)} 张图片保存在检查点 {checkpoint}，"
+                         f"用相同的参数重新运行即可继续")
+        raise
+
+    if journal is not None:
+        stats.checkpoint = {
+            'directory': checkpoint, 'resumed': journal.resumed, 'recorded': len(journal.entries),
+        }
+        if failures:
+            journal.close()
+            logger.warning(f"跳过了 {len(failures)} 张图片，检查点 {checkpoint} 已保留，"
+                           f"修复后用相同的参数重新运行只会处理这些图片")
+        else:
+            journal.discard()
+    return EmbedResult(
+        count, len(package.images_by_hash), package.bytes_saved, elapsed, stats.report(), failures
     )
-    
-    # 添加avLst元素
-    av_lst = etree.SubElement(
-        prst_geom,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}avLst'
+
+
+# 库接口：按映射把图片内嵌到单元格，生成新的Excel文件
+# mapping是 (工作表名, 单元格地址, 图片源) 的可迭代对象，可以是生成器；
+# 图片源可以是文件路径、内存中的图片数据（bytes/memoryview或ImageSource）或可读的文件对象，
+# 内存中的图片不需要先写入磁盘。调用方传入的缓冲区（包括mmap）不会被关闭，可以用于多个单元格；
+# 文件对象会被读取到末尾，只能用于一个单元格。
+# 工作表名为None时使用第一个工作表，不存在的工作表会自动创建。
+# output可以是文件路径或可写的文件对象（包括不能seek的流，例如网络连接），
+# executor是可选的共用图片准备工作池，stats是可选的PipelineStats（例如需要每张图片的明细时）。
+# checkpoint是可选的检查点目录，中途失败后用相同的参数重新运行时跳过已完成的图片；
+# skip_errors为True时跳过无法处理的图片，记录在结果的failures中，不中断整个批次；
+# xml_level覆盖输出配置中XML等部件的deflate压缩级别（0-9，None表示使用profile的设置）
+def embed_images(output, mapping, profile=DEFAULT_PROFILE, workers=DEFAULT_WORKERS,
+                 use_processes=False, transform=None, cache=None,
+                 column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT, on_added=None, executor=None,
+                 stats=None, checkpoint=None, skip_errors=False, xml_level=None):
+    if stats is None:
+        stats = PipelineStats()
+    records = iter(mapping)
+    first = next(records, None)
+    jobs = itertools.chain([first], records) if first is not None else iter(())
+
+    # 基础工作簿的第一个工作表使用映射中第一条记录的工作表名
+    first_sheet = first[0] if first is not None and first[0] else 'Sheet1'
+    with stats.measure('base') as stage:
+        base_excel = create_base_excel(first_sheet)
+        stage['bytes_written'] += len(base_excel.getbuffer())
+    return _build_workbook(
+        base_excel, output, jobs, profile, workers, use_processes, transform, cache,
+        column_width, row_height, on_added, executor, stats, checkpoint, skip_errors=skip_errors,
+        xml_level=xml_level
     )
-    
-    # 添加noFill元素
-    no_fill = etree.SubElement(
-        sp_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}noFill'
+
+
+# 库接口：把图片追加内嵌到已有的Excel文件中
+# 复用已有的cellimages.xml、关系和内容类型，只重写需要修改的部件
+# （内容类型、工作簿、关系、cellimages.xml和用到的工作表），其余成员按原始压缩数据复制，
+# 开销取决于新增图片的数量，而不是工作簿中已有的内容。
+# output为None时原地更新：先写入同目录下的临时文件，成功后再替换原文件
+def append_images(workbook, mapping, output=None, profile=DEFAULT_PROFILE,
+                  workers=DEFAULT_WORKERS, use_processes=False, transform=None, cache=None,
+                  column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT, on_added=None, stats=None,
+                  checkpoint=None, skip_errors=False, xml_level=None):
+    if output is None:
+        output = workbook
+    in_place = (
+        isinstance(output, (str, os.PathLike)) and os.path.exists(output)
+        and os.path.samefile(workbook, output)
     )
-    
-    # 添加ln元素
-    ln = etree.SubElement(
-        sp_pr,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}ln',
-        w='9525'
+    target = f'{output}.{uuid.uuid4().hex}.tmp' if in_place else output
+
+    result = _build_workbook(
+        workbook, target, iter(mapping), profile, workers, use_processes, transform, cache,
+        column_width, row_height, on_added, stats=stats, checkpoint=checkpoint,
+        base_identity=file_identity(workbook) if checkpoint is not None else None,
+        skip_errors=skip_errors, xml_level=xml_level
     )
+    if in_place:
+        shutil.copymode(workbook, target)
+        os.replace(target, workbook)
+    return result
+
+
+# 库接口：按CSV/JSONL清单生成带数据的目录式工作簿
+# 清单读取两遍，都是逐条流式读取：第一遍用XlsxWriter的constant_memory模式把行数据写入基础文件，
+# 第二遍把图片按清单顺序送入并行流水线，并在同一个工作表中插入图片单元格。
+# 清单有几百万行也不需要全部读入内存
+def embed_manifest(output, manifest_path, image_column='A', sheet_name=None,
+                   profile=DEFAULT_PROFILE, workers=DEFAULT_WORKERS, use_processes=False,
+                   transform=None, cache=None, column_width=COLUMN_WIDTH, row_height=ROW_HEIGHT,
+                   on_added=None, stats=None, checkpoint=None, skip_errors=False, xml_level=None):
+    if stats is None:
+        stats = PipelineStats()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rows = (
+            (sheet, data)
+            for sheet, _, _, data in manifest_entries(manifest_path, image_column, sheet_name)
+        )
+        with stats.measure('base') as stage:
+            base_excel = create_base_excel(rows=rows, output=os.path.join(temp_dir, 'base.xlsx'))
+            stage['bytes_written'] += os.path.getsize(base_excel)
+
+        jobs = (
+            (sheet, cell_address, image_path)
+            for sheet, cell_address, image_path, _ in manifest_entries(
+                manifest_path, image_column, sheet_name
+            )
+        )
+        return _build_workbook(
+            base_excel, output, jobs, profile, workers, use_processes, transform, cache,
+            column_width, row_height, on_added, stats=stats, checkpoint=checkpoint,
+            base_identity=file_identity(manifest_path) if checkpoint is not None else None,
+            skip_errors=skip_errors, xml_level=xml_level
+        )
+
+
+# 按布局生成单元格地址：从start开始横向排列，per_row大于0时每行per_row个
+def layout_cells(start='B1', per_row=0):
+    start_row, start_col = cell_to_rowcol(start)
+    for i in itertools.count():
+        if per_row > 0:
+            yield rowcol_to_cell(start_row + i // per_row, start_col + i % per_row)
+        else:
+            yield rowcol_to_cell(start_row, start_col + i)
+
+
+# 分片输出的文件名：catalog.xlsx -> catalog_001.xlsx
+def shard_path(output, index):
+    root, ext = os.path.splitext(output)
+    return f'{root}_{index + 1:03d}{ext}'
+
+
+# 把图片按每个工作表、每个文件的数量上限（0表示不限制）分配到工作表和文件中，
+# 依次生成每个文件的映射 [(工作表名, 单元格地址, 图片路径), ...]，只在需要时读取下一批图片。
+# 限制了每个工作表的数量时，工作表依次命名为 sheet_name1、sheet_name2...（默认为Sheet1、Sheet2...），
+# 每个工作表都从start开始布局
+def shard_mapping(image_files, per_sheet=0, per_file=0, start='B1', per_row=0, sheet_name=None):
+    images = iter(image_files)
+    while True:
+        batch = list(itertools.islice(images, per_file) if per_file else images)
+        if not batch:
+            return
+        mapping = []
+        for i, image_path in enumerate(batch):
+            if not per_sheet:
+                name = sheet_name
+            elif i % per_sheet == 0:
+                name = f'{sheet_name or "Sheet"}{i // per_sheet + 1}'
+                validate_sheet_name(name)
+            if i == 0 or (per_sheet and i % per_sheet == 0):
+                cells = layout_cells(start, per_row)
+            mapping.append((name, next(cells), image_path))
+        yield mapping
+        if not per_file:
+            return
+
+
+# 在工作进程中生成一个分片
+def _build_shard(output, mapping, options):
+    return embed_images(output, mapping, **options)
+
+
+# 库接口：分片输出
+# WPS中单个cellimages.xml包含几万张图片时会明显变慢，而每个工作簿只有一个cellimages.xml，
+# 因此按per_file把图片分到多个工作簿（output_001.xlsx、output_002.xlsx...，只有一个分片时直接写入output），
+# 每个工作簿内再按per_sheet分到多个工作表。
+# 各分片在独立的进程中并行生成（processes个进程，每个进程内部仍按workers并发准备图片），
+# 同时在途的分片数有上限，图片列表可以是生成器。返回 [(文件路径, EmbedResult)]。
+# 指定checkpoint时每个分片使用检查点目录下以分片文件名命名的子目录
+def embed_images_sharded(output, image_files, per_sheet=0, per_file=0, start='B1', per_row=0,
+                         sheet_name=None, processes=None, **options):
+    from concurrent.futures import ProcessPoolExecutor
+
+    checkpoint = options.pop('checkpoint', None)
+
+    def shard_options(path):
+        if checkpoint is None:
+            return options
+        return dict(options, checkpoint=os.path.join(checkpoint, os.path.basename(path)))
+
+    shards = shard_mapping(image_files, per_sheet, per_file, start, per_row, sheet_name)
+    first = next(shards, None)
+    if first is None:
+        return []
+    second = next(shards, None)
+    if second is None:
+        return [(output, embed_images(output, first, checkpoint=checkpoint, **options))]
+
+    shards = enumerate(itertools.chain([first, second], shards))
+    processes = processes or os.cpu_count() or 1
+    if processes <= 1:
+        results = []
+        for index, mapping in shards:
+            path = shard_path(output, index)
+            results.append((path, embed_images(path, mapping, **shard_options(path))))
+        return results
+
+    results = []
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for index, mapping in shards:
+            path = shard_path(output, index)
+            pending.append((path, executor.submit(_build_shard, path, mapping, shard_options(path))))
+            if len(pending) >= processes * 2:
+                path, future = pending.popleft()
+                results.append((path, future.result()))
+        while pending:
+            path, future = pending.popleft()
+            results.append((path, future.result()))
+    return results
+
+
+# 生成了输出文件、但有图片因为--skip-errors被跳过时的退出状态
+EXIT_SKIPPED = 2
+
+
+# 命令行参数
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='把图片以DISPIMG方式内嵌到WPS Excel单元格中')
+    parser.add_argument('inputs', nargs='*',
+                        help=f'图片目录或图片文件，默认为{IMG_DIR}')
+    parser.add_argument('-m', '--manifest', action='append', default=[],
+                        help='清单文件，每行一个图片路径，可以指定多次；'
+                             '.csv/.jsonl清单按记录生成带行数据的工作簿')
+    parser.add_argument('--image-column', default='A',
+                        help='CSV/JSONL清单中图片所在的列，数据字段依次写在其右侧')
+    parser.add_argument('-o', '--output',
+                        help=f'输出文件，默认为{OUTPUT_EXCEL}；追加时默认原地更新')
+    parser.add_argument('--append', metavar='WORKBOOK',
+                        help='追加到已有的Excel文件，而不是新建')
+    parser.add_argument('--sheet', help='目标工作表，默认为第一个工作表，不存在时新建')
+    parser.add_argument('--start', help='第一张图片的单元格，默认为B1（指定--per-row时为A1）')
+    parser.add_argument('--per-row', type=int, default=0,
+                        help='每行放几张图片，默认全部放在同一行')
+    parser.add_argument('--per-sheet', type=int, default=0,
+                        help='每个工作表最多放几张图片，超出后新建工作表（Sheet1、Sheet2...或--sheet加序号）')
+    parser.add_argument('--per-file', type=int, default=0,
+                        help='每个文件最多放几张图片，超出后分片输出到多个文件（输出文件名加_001、_002...）')
+    parser.add_argument('--shard-processes', type=int, default=0,
+                        help='并行生成分片的进程数，默认为CPU核数')
+    parser.add_argument('--profile', choices=sorted(OUTPUT_PROFILES), default=DEFAULT_PROFILE,
+                        help='输出压缩配置')
+    parser.add_argument('--xml-level', type=int, choices=range(10), metavar='0-9',
+                        help='XML等部件的deflate压缩级别，默认使用--profile的设置')
+    parser.add_argument('--workers', type=int, default=DEFAULT_WORKERS,
+                        help='图片准备阶段的并发数')
+    parser.add_argument('--processes', action='store_true', help='使用进程池而不是线程池')
+    parser.add_argument('--fit-to-cell', action='store_true',
+                        help='把图片缩小到单元格大小')
+    parser.add_argument('--convert-to', choices=['jpeg', 'webp'],
+                        help='把BMP/PNG照片转换为JPEG或WebP')
+    parser.add_argument('--quality', type=int, default=85, help='JPEG/WebP的编码质量')
+    parser.add_argument('--cache-dir', help='已处理图片的缓存目录')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='缓存容量上限（字节）')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                        help='检查点目录：记录已完成准备的图片和分配的ID，中途失败后用相同的参数重新运行，'
+                             '只处理剩下的图片并重新组装输出文件')
+    parser.add_argument('--skip-errors', action='store_true',
+                        help=f'跳过无法处理的图片（单元格留空），而不是中止整个批次；'
+                             f'有图片被跳过时以状态{EXIT_SKIPPED}退出')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='日志级别')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        help='输出DEBUG级别日志，包括每张图片的进度')
+    parser.add_argument('-q', '--quiet', action='store_true', help='只输出警告和错误')
+    parser.add_argument('--report', metavar='FILE', help='把分阶段的耗时、读写字节数和峰值内存写成JSON')
+    parser.add_argument('--report-images', action='store_true', help='报告中包含每张图片的明细')
+    parser.add_argument('--cprofile', metavar='FILE', help='用cProfile分析整个运行过程，结果写入FILE')
+    parser.add_argument('--tracemalloc', type=int, default=0, metavar='N',
+                        help='用tracemalloc跟踪内存分配，报告中列出占用最多的N个位置')
+    return parser.parse_args(argv)
+
+
+# 按命令行参数生成图片变换
+def build_transform(args):
+    if args.fit_to_cell:
+        return fit_to_cell_transform(convert_to=args.convert_to, quality=args.quality)
+    if args.convert_to:
+        return ImageTransform(convert_to=args.convert_to, quality=args.quality)
+    return None
+
+
+# 按命令行参数收集图片文件
+def collect_image_files(args):
+    image_files = []
+    inputs = args.inputs
+    if not inputs and not args.manifest:
+        # 确保默认图片目录存在
+        if not os.path.exists(IMG_DIR):
+            os.makedirs(IMG_DIR)
+            logger.warning(f"创建了目录: {IMG_DIR}")
+            logger.warning("请将图片文件放入该目录后重新运行脚本")
+            return None
+        inputs = [IMG_DIR]
+
+    for path in inputs:
+        if os.path.isdir(path):
+            image_files.extend(find_image_files(path))
+        elif os.path.isfile(path):
+            image_files.append(path)
+        else:
+            logger.error(f"找不到图片目录或文件: {path}")
+            return None
+    for manifest in args.manifest:
+        image_files.extend(read_image_list(manifest))
+    return image_files
+
+
+# 汇总跳过的图片（每张图片在跳过时已经输出了警告），返回退出状态
+def log_failures(failures):
+    if not failures:
+        return 0
+    logger.warning(f"⚠️ 跳过了 {len(failures)} 张无法处理的图片，对应的单元格留空")
+    return EXIT_SKIPPED
+
+
+# CSV/JSONL清单：生成带行数据的工作簿
+def run_manifest(args, manifest, options):
+    if args.inputs or len(args.manifest) > 1 or args.append or args.per_file:
+        logger.error("CSV/JSONL清单不能与其他图片输入、--append或--per-file同时使用")
+        return 1
+    if not os.path.isfile(manifest):
+        logger.error(f"找不到清单文件: {manifest}")
+        return 1
+    try:
+        column_index(args.image_column)
+    except ValueError as e:
+        logger.error(e)
+        return 1
+
+    output = args.output or OUTPUT_EXCEL
+    logger.info(f"按清单 {manifest} 生成Excel文件: {output}")
+    result = embed_manifest(output, manifest, args.image_column, args.sheet, **options)
+    logger.info(f"\n处理 {result.count} 张图片耗时 {result.elapsed:.2f} 秒，"
+                f"吞吐量 {result.count / max(result.elapsed, 1e-9):.1f} 张/秒")
+    status = log_failures(result.failures)
+    logger.info(f"\n✅ 成功生成WPS内嵌图片Excel文件: {output}")
+    return status
+
+
+# 按命令行参数生成工作簿，返回退出状态；分阶段统计记录在stats中
+def run(args, stats):
+    if args.sheet is not None:
+        try:
+            validate_sheet_name(args.sheet)
+        except ValueError as e:
+            logger.error(e)
+            return 1
+
+    data_manifests = [m for m in args.manifest if m.lower().endswith(MANIFEST_EXTENSIONS)]
+    if data_manifests:
+        options = dict(
+            profile=args.profile, workers=args.workers, use_processes=args.processes,
+            transform=build_transform(args),
+            cache=ImageCache(args.cache_dir, args.cache_size) if args.cache_dir else None,
+            stats=stats, checkpoint=args.checkpoint,
+            skip_errors=args.skip_errors, xml_level=args.xml_level
+        )
+        return run_manifest(args, data_manifests[0], options)
+
+    image_files = collect_image_files(args)
+    if image_files is None:
+        return 1
+    if not image_files:
+        logger.error("没有找到图片文件")
+        return 1
+
+    transform = build_transform(args)
+    cache = ImageCache(args.cache_dir, args.cache_size) if args.cache_dir else None
     
-    # 添加ln的noFill元素
-    ln_no_fill = etree.SubElement(
-        ln,
-        '{http://schemas.openxmlformats.org/drawingml/2006/main}noFill'
+    # 默认布局：从B1开始横向排列；指定--per-row时从A1开始按行排列
+    start = args.start or ('A1' if args.per_row > 0 else 'B1')
+    try:
+        cell_to_rowcol(start)
+        if args.per_sheet:
+            validate_sheet_name(f'{args.sheet or "Sheet"}{len(image_files)}')
+    except ValueError as e:
+        logger.error(e)
+        return 1
+    if args.append and args.per_file:
+        logger.error("追加到已有文件时不能使用--per-file")
+        return 1
+
+    options = dict(
+        profile=args.profile, workers=args.workers, use_processes=args.processes,
+        transform=transform, cache=cache, checkpoint=args.checkpoint,
+        skip_errors=args.skip_errors, xml_level=args.xml_level
     )
-    
-    tree.write(cellimages_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    print(f"已更新cellimages.xml，添加图片ID: {image_id}, rId: {new_r_id}")
-    return image_id, new_r_id
-
-# 步骤7: 更新cellimages.xml.rels
-def update_cellimages_rels(extract_dir, image_name, r_id):
-    cellimages_rels_dir = os.path.join(extract_dir, 'xl', '_rels')
-    if not os.path.exists(cellimages_rels_dir):
-        os.makedirs(cellimages_rels_dir)
-    
-    cellimages_rels_path = os.path.join(cellimages_rels_dir, 'cellimages.xml.rels')
-    
-    # 如果文件不存在，创建它
-    if not os.path.exists(cellimages_rels_path):
-        root = etree.Element('{http://schemas.openxmlformats.org/package/2006/relationships}Relationships')
-        tree = etree.ElementTree(root)
-        tree.write(cellimages_rels_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    
-    # 解析现有文件
-    parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
-    tree = etree.parse(cellimages_rels_path, parser)
-    root = tree.getroot()
-    
-    # 添加新的关系
-    xml_string = f'''<Relationship Id="{r_id}" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" Target="media/{image_name}"/>'''
-    new_elem = etree.fromstring(xml_string, parser)
-    root.append(new_elem)
-    
-    tree.write(cellimages_rels_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    print(f"已更新cellimages.xml.rels，添加图片: {image_name}")
-
-# 步骤8: 更新工作表XML，替换占位符
-def update_worksheet(extract_dir, image_id, column_index):
-    worksheet_path = os.path.join(extract_dir, 'xl', 'worksheets', 'sheet1.xml')
-    parser = etree.XMLParser(load_dtd=False, no_network=True, recover=True)
-    tree = etree.parse(worksheet_path, parser)
-    root = tree.getroot()
-    
-    # 找到sheetData元素
-    sheet_data = root.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}sheetData')
-    if sheet_data is None:
-        return
-    
-    # 找到第一行
-    row = sheet_data.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}row')
-    if row is None:
-        return
-    
-    # 找到对应的单元格（B1, C1, D1等）
-    column_letter = chr(ord('B') + column_index)
-    cell_address = f'{column_letter}1'
-    
-    cells = row.findall('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}c')
-    cell = None
-    for c in cells:
-        if c.get('r') == cell_address:
-            cell = c
-            break
-    
-    if cell is None:
-        return
-    
-    # 确保单元格的r属性值正确
-    cell.set('r', cell_address)
-    
-    # 为DISPIMG函数设置单元格类型为str（与正常文件保持一致）
-    cell.set('t', 'str')
-    
-    # 更新f元素（公式）
-    f_elem = cell.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}f')
-    if f_elem is not None:
-        f_elem.text = f'_xlfn.DISPIMG("{image_id}",1)'
-        # 设置公式属性
-        f_elem.set('t', 'shared')
-        f_elem.set('ref', f'{chr(ord("B") + column_index)}1')
-    
-    # 更新v元素（值）
-    v_elem = cell.find('{http://schemas.openxmlformats.org/spreadsheetml/2006/main}v')
-    if v_elem is not None:
-        # 对于DISPIMG函数，v元素应该是公式本身，与正常文件保持一致
-        v_elem.text = f'=DISPIMG("{image_id}",1)'
-    
-    tree.write(worksheet_path, pretty_print=True, xml_declaration=True, encoding='UTF-8')
-    column_letter = chr(ord('B') + column_index)
-    print(f"已更新工作表，在单元格 {column_letter}1 设置图片ID: {image_id}")
-
-# 步骤9: 重新压缩Excel文件
-def zip_excel(extract_dir, output_path):
-    print(f"重新压缩Excel文件到: {output_path}")
-    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
-        for root_dir, _, files in os.walk(extract_dir):
-            for file in files:
-                file_path = os.path.join(root_dir, file)
-                arcname = os.path.relpath(file_path, extract_dir)
-                zip_ref.write(file_path, arcname)
+    if args.per_file:
+        output = args.output or OUTPUT_EXCEL
+        logger.info(f"分片写入Excel文件: 每个文件最多 {args.per_file} 张图片")
+        start_time = time.perf_counter()
+        results = embed_images_sharded(
+            output, image_files, args.per_sheet, args.per_file, start, args.per_row, args.sheet,
+            args.shard_processes, **options
+        )
+        elapsed = time.perf_counter() - start_time
+        logger.info("")
+        for path, result in results:
+            logger.info(f"✅ {path}: {result.count} 张图片")
+        status = log_failures([failure for _, result in results for failure in result.failures])
+        logger.info(f"\n共 {len(results)} 个文件、{len(image_files)} 张图片，耗时 {elapsed:.2f} 秒，"
+                    f"吞吐量 {len(image_files) / max(elapsed, 1e-9):.1f} 张/秒")
+        stats.shards = [dict(path=path, **result.report) for path, result in results]
+        return status
+
+    mapping = next(shard_mapping(image_files, args.per_sheet, 0, start, args.per_row, args.sheet))
+
+    # 每张图片一行的进度只在DEBUG级别输出，默认级别下不产生格式化和输出的开销
+    if logger.isEnabledFor(logging.DEBUG):
+        def on_added(sheet_name, cell_address, image_id, r_id):
+            logger.debug(f"已在单元格 {cell_address} 设置图片ID: {image_id}, rId: {r_id}")
+
+        options['on_added'] = on_added
+    options['stats'] = stats
+    if args.append:
+        if not os.path.isfile(args.append):
+            logger.error(f"找不到要追加的Excel文件: {args.append}")
+            return 1
+        output = args.output or args.append
+        logger.info(f"追加到已有Excel文件: {args.append} -> {output}")
+        result = append_images(args.append, mapping, output, **options)
+    else:
+        output = args.output or OUTPUT_EXCEL
+        logger.info(f"流式写入Excel文件: {output}")
+        result = embed_images(output, mapping, **options)
+    logger.info(f"\n处理 {result.count} 张图片耗时 {result.elapsed:.2f} 秒，"
+                f"吞吐量 {result.count / max(result.elapsed, 1e-9):.1f} 张/秒（{args.workers} 个工作线程）")
+    if cache is not None:
+        logger.info(cache.summary())
+    status = log_failures(result.failures)
+
+    logger.info(f"\n\n✅ 成功生成WPS内嵌图片Excel文件: {output}")
+    logger.info(f"共处理 {len(image_files)} 张图片")
+    logger.info(f"图片已内嵌到单元格 {mapping[0][1]}-{mapping[-1][1]}")
+    logger.info(f"使用WPS打开文件，图片将真正内嵌在单元格中，无法移动")
+    return status
+
 
 # 主函数
-def main():
-    # 创建临时目录
-    with tempfile.TemporaryDirectory() as temp_dir:
-        # 1. 创建基础Excel文件
-        base_excel = create_base_excel()
-        
-        try:
-            # 2. 解压Excel文件
-            extract_dir = os.path.join(temp_dir, 'excel_extract')
-            os.makedirs(extract_dir)
-            unzip_excel(base_excel, extract_dir)
-            
-            # 3. 更新Content_Types.xml和workbook.xml.rels
-            update_content_types(extract_dir)
-            update_workbook_rels(extract_dir)
-            
-            # 4. 处理每个图片
-            for i, image_file in enumerate(image_files):
-                print(f"\n处理图片 {i+1}/{len(image_files)}: {image_file}")
-                
-                # 复制图片到Excel的media目录
-                image_name, dest_path = copy_image_to_excel(image_file, extract_dir)
-                
-                # 更新cellimages.xml
-                image_id, r_id = update_cellimages(extract_dir, image_name, dest_path)
-                
-                # 更新cellimages.xml.rels
-                update_cellimages_rels(extract_dir, image_name, r_id)
-                
-                # 更新工作表
-                update_worksheet(extract_dir, image_id, i)
-            
-            # 5. 重新压缩Excel文件
-            output_excel = 'images_wps_embedded.xlsx'
-            zip_excel(extract_dir, output_excel)
-            
-            print(f"\n\n✅ 成功生成WPS内嵌图片Excel文件: {output_excel}")
-            print(f"共处理 {len(image_files)} 张图片")
-            print(f"图片已内嵌到单元格 B1-{chr(ord('B') + len(image_files) - 1)}1")
-            print(f"使用WPS打开文件，图片将真正内嵌在单元格中，无法移动")
-            
-        finally:
-            # 清理临时文件
-            if os.path.exists(base_excel):
-                os.remove(base_excel)
+# --cprofile把整个运行过程的cProfile结果写入文件（可以用python -m pstats查看），
+# --tracemalloc N在报告中记录各阶段的Python内存分配峰值和结束时占用最多的N个分配位置，
+# --report把分阶段统计写成JSON
+def main(argv=None):
+    args = parse_args(argv)
+    level = logging.DEBUG if args.verbose else logging.WARNING if args.quiet else args.log_level
+    logging.basicConfig(level=level, format='%(message)s', stream=sys.stdout)
+
+    profiler = None
+    if args.cprofile:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if args.tracemalloc:
+        import tracemalloc
+        tracemalloc.start()
+
+    stats = PipelineStats(per_image=args.report_images)
+    try:
+        status = run(args, stats)
+    except (CheckpointError, ImageError, WorkbookError, ManifestError) as e:
+        logger.error(f"❌ {e}")
+        status = 1
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            logger.info(f"cProfile结果已写入: {args.cprofile}")
+
+    report = stats.report()
+    if args.tracemalloc:
+        top = tracemalloc.take_snapshot().statistics('lineno')[:args.tracemalloc]
+        tracemalloc.stop()
+        report['tracemalloc'] = [
+            {'site': str(stat.traceback), 'size': stat.size, 'count': stat.count} for stat in top
+        ]
+    if status in (0, EXIT_SKIPPED) and stats.stages:
+        logger.info("")
+        for line in format_stages(report):
+            logger.info(line)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        logger.info(f"统计报告已写入: {args.report}")
+    return status
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
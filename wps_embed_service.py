@@ -0,0 +1,496 @@
+import os
+import sys
+import json
+import base64
+import time
+import asyncio
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import insert_images_wps_embedded as wps
+
+XLSX_CONTENT_TYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# 请求体大小上限（图片列表的JSON）
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# 输出流按块发送，同时在途的块数有上限：
+# 客户端读取得慢时写入阶段会被阻塞（背压），每个请求的缓冲不超过 块大小 × 块数
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_QUEUE_SIZE = 16
+
+DEFAULT_PORT = 8765
+
+logger = logging.getLogger('wps_embed_service')
+
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 503: 'Service Unavailable',
+}
+
+
+# 写入阶段（工作线程）的输出流：攒够一块后交给事件循环发送，队列满时阻塞写入线程。
+# 没有tell/seek，ZipFile会按不能seek的流写入（使用数据描述符）
+class ChunkStream:
+    def __init__(self, loop, queue):
+        self.loop = loop
+        self.queue = queue
+        self.buffer = bytearray()
+        self.cancelled = False
+        self.bytes_sent = 0
+
+    def write(self, data):
+        if self.cancelled:
+            raise ConnectionError("客户端已断开连接")
+        self.buffer += data
+        if len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self._push(bytes(self.buffer))
+            self.buffer.clear()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _push(self, chunk):
+        self.bytes_sent += len(chunk) if chunk else 0
+        asyncio.run_coroutine_threadsafe(self.queue.put(chunk), self.loop).result()
+
+    # 发送剩余的数据和结束标记（None）
+    def finish(self):
+        if self.buffer and not self.cancelled:
+            self._push(bytes(self.buffer))
+        self.buffer.clear()
+        self._push(None)
+
+
+# 读取HTTP请求头，返回 (方法, 路径, 请求头, 请求体长度)
+# 请求体由调用方在决定接收请求之后再读取
+async def read_request_head(reader):
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.LimitOverrunError:
+        raise ValueError("请求头过长")
+    lines = head.decode('latin-1').split('\r\n')
+    try:
+        method, target, _ = lines[0].split(' ', 2)
+    except ValueError:
+        raise ValueError(f"无效的请求行: {lines[0]!r}")
+    headers = {}
+    for line in lines[1:]:
+        if ':' in line:
+            key, value = line.split(':', 1)
+            headers[key.strip().lower()] = value.strip()
+
+    length = int(headers.get('content-length') or 0)
+    if length > MAX_BODY_SIZE:
+        raise OverflowError(f"请求体超过 {MAX_BODY_SIZE} 字节")
+    return method, target.split('?', 1)[0], headers, length
+
+
+def response_head(status, headers):
+    lines = [f'HTTP/1.1 {status} {HTTP_REASONS.get(status, "")}']
+    lines += [f'{key}: {value}' for key, value in headers.items()]
+    lines.append('Connection: close')
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def send_json(writer, status, payload, headers=None):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(response_head(status, {
+        'Content-Type': 'application/json; charset=utf-8',
+        'Content-Length': len(body), **(headers or {}),
+    }) + body)
+    await writer.drain()
+
+
+# 请求参数错误，status是返回的HTTP状态码
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# 长期运行的内嵌图片服务
+#   POST /embed   请求体为JSON，返回边生成边发送的.xlsx（chunked）
+#   GET  /status  当前运行、排队和完成的请求数
+# 所有请求共用一个有上限的图片准备线程池；同时生成的工作簿数由max_concurrent限制，
+# 超出的请求排队，排队数超过max_queue时直接返回503
+class EmbedService:
+    def __init__(self, root, workers=wps.DEFAULT_WORKERS, max_concurrent=2, max_queue=8,
+                 cache=None):
+        self.root = os.path.realpath(root)
+        self.workers = workers
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.cache = cache
+        self.prepare_executor = ThreadPoolExecutor(max_workers=workers)
+        self.build_executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        # 请求体解析单独使用有上限的线程池，不占用生成工作簿的线程
+        self.parse_executor = ThreadPoolExecutor(max_workers=max_concurrent)
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def close(self):
+        self.parse_executor.shutdown()
+        self.build_executor.shutdown()
+        self.prepare_executor.shutdown()
+
+    async def handle(self, reader, writer):
+        try:
+            try:
+                method, path, _, length = await read_request_head(reader)
+            except OverflowError as e:
+                await send_json(writer, 413, {'error': str(e)})
+                return
+            except (ValueError, asyncio.IncompleteReadError) as e:
+                await send_json(writer, 400, {'error': str(e) or "请求不完整"})
+                return
+
+            if path == '/status':
+                await send_json(writer, 200, self.status())
+            elif path == '/embed':
+                if method != 'POST':
+                    await send_json(writer, 405, {'error': "只支持POST"}, {'Allow': 'POST'})
+                    return
+                await self.embed(reader, length, writer)
+            else:
+                await send_json(writer, 404, {'error': f"未知路径: {path}"})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    def status(self):
+        return {
+            'active': self.active, 'waiting': self.waiting, 'completed': self.completed,
+            'failed': self.failed, 'rejected': self.rejected,
+            'max_concurrent': self.max_concurrent, 'max_queue': self.max_queue,
+        }
+
+    # 图片路径必须位于root目录内，相对路径相对于root
+    # 请求中的图片也可以直接携带数据 {"data": "<base64>", "name": "可选的文件名"}，
+    # 解码后作为内存图片源交给生成器，不写入磁盘
+    def resolve_image(self, image_path):
+        if isinstance(image_path, dict):
+            try:
+                data = base64.b64decode(image_path['data'], validate=True)
+            except (KeyError, TypeError, ValueError):
+                raise RequestError(400, "图片数据必须是base64编码的data字段")
+            # 只读取文件头，提前拒绝无法识别的数据，避免开始发送响应后才失败
+            try:
+                wps.probe_image_size(data)
+            except Exception:
+                raise RequestError(400, "无法识别的图片数据")
+            name = image_path.get('name')
+            return wps.ImageSource(data, name if isinstance(name, str) else None)
+        if not isinstance(image_path, str) or not image_path:
+            raise RequestError(400, f"无效的图片路径: {image_path!r}")
+        path = os.path.realpath(os.path.join(self.root, image_path))
+        if os.path.commonpath([self.root, path]) != self.root:
+            raise RequestError(403, f"图片路径不在服务目录内: {image_path}")
+        if not os.path.isfile(path):
+            raise RequestError(400, f"找不到图片: {image_path}")
+        # 与内嵌数据一样只读取文件头探测，损坏或不是图片的文件直接返回400
+        try:
+            wps.probe_image_size(path)
+        except Exception:
+            raise RequestError(400, f"无法识别的图片: {image_path}")
+        return path
+
+    # 解析请求体，返回 (映射, embed_images的参数)
+    #   images     图片列表，按start/per_row/sheet布局；或者
+    #   mapping    [[工作表名, 单元格地址, 图片], ...]
+    #   图片是服务目录内的路径，或者 {"data": "<base64>", "name": "..."}
+    #   profile、fit_to_cell、convert_to、quality  与命令行参数相同
+    # 所有字段在这里检查，开始发送200响应之后不会再因为请求本身的问题失败
+    def parse_body(self, body):
+        try:
+            request = json.loads(body or b'{}')
+        except ValueError as e:
+            raise RequestError(400, f"请求体不是有效的JSON: {e}")
+        if not isinstance(request, dict):
+            raise RequestError(400, "请求体必须是JSON对象")
+
+        try:
+            if 'mapping' in request:
+                mapping = [
+                    (sheet, wps.rowcol_to_cell(*wps.cell_to_rowcol(cell)), self.resolve_image(path))
+                    for sheet, cell, path in request['mapping']
+                ]
+                for sheet in {sheet for sheet, _, _ in mapping}:
+                    if sheet is not None:
+                        wps.validate_sheet_name(sheet)
+            else:
+                if request.get('sheet') is not None:
+                    wps.validate_sheet_name(request['sheet'])
+                images = [self.resolve_image(path) for path in request.get('images') or []]
+                per_row = int(request.get('per_row') or 0)
+                start = request.get('start') or ('A1' if per_row > 0 else 'B1')
+                mapping = next(
+                    wps.shard_mapping(images, 0, 0, start, per_row, request.get('sheet')), []
+                )
+
+            profile = request.get('profile', wps.DEFAULT_PROFILE)
+            if profile not in wps.OUTPUT_PROFILES:
+                raise ValueError(f"未知的输出配置: {profile}")
+            quality = int(request.get('quality', 85))
+            if not 1 <= quality <= 100:
+                raise ValueError(f"编码质量必须在1到100之间: {quality}")
+            convert_to = request.get('convert_to')
+            if convert_to not in (None, 'jpeg', 'webp'):
+                raise ValueError(f"不支持的转换格式: {convert_to}")
+        except (TypeError, ValueError) as e:
+            raise RequestError(400, str(e))
+        if not mapping:
+            raise RequestError(400, "没有要内嵌的图片")
+
+        transform = None
+        if request.get('fit_to_cell'):
+            transform = wps.fit_to_cell_transform(convert_to=convert_to, quality=quality)
+        elif convert_to:
+            transform = wps.ImageTransform(convert_to=convert_to, quality=quality)
+        return mapping, {'profile': profile, 'transform': transform}
+
+    async def embed(self, reader, length, writer):
+        # 在读取请求体之前检查排队数：排队的请求太多时直接拒绝，让调用方稍后重试，
+        # 不为注定被拒绝的请求接收和解析最多MAX_BODY_SIZE字节的请求体
+        if self.active >= self.max_concurrent and self.waiting >= self.max_queue:
+            self.rejected += 1
+            await send_json(writer, 503, {'error': "服务繁忙，请稍后重试"}, {'Retry-After': 1})
+            return
+
+        # 接收和解析请求体期间已经占用一个排队名额
+        self.waiting += 1
+        try:
+            try:
+                body = await reader.readexactly(length) if length else b''
+            except asyncio.IncompleteReadError:
+                await send_json(writer, 400, {'error': "请求不完整"})
+                return
+            # JSON解析、base64解码、文件检查和图片头探测都可能耗时，放到线程中执行，不阻塞其他请求的发送
+            try:
+                mapping, options = await asyncio.get_running_loop().run_in_executor(
+                    self.parse_executor, self.parse_body, body
+                )
+            except RequestError as e:
+                await send_json(writer, e.status, {'error': str(e)})
+                return
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        try:
+            await self.stream_workbook(mapping, options, writer)
+        finally:
+            self.active -= 1
+            self.slots.release()
+
+    # 在写入线程中生成工作簿，同时把已经生成的字节按chunked编码发送给客户端
+    async def stream_workbook(self, mapping, options, writer):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(STREAM_QUEUE_SIZE)
+        stream = ChunkStream(loop, queue)
+
+        def build():
+            try:
+                return wps.embed_images(
+                    stream, mapping, workers=self.workers, cache=self.cache,
+                    executor=self.prepare_executor, **options
+                )
+            finally:
+                stream.finish()
+
+        start = time.perf_counter()
+        build_future = loop.run_in_executor(self.build_executor, build)
+        writer.write(response_head(200, {
+            'Content-Type': XLSX_CONTENT_TYPE,
+            'Content-Disposition': 'attachment; filename="images_wps_embedded.xlsx"',
+            'Transfer-Encoding': 'chunked',
+        }))
+
+        # 一直读到结束标记，客户端断开后继续取出剩余的块，让写入线程尽快结束
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            if stream.cancelled:
+                continue
+            try:
+                writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                await writer.drain()
+            except ConnectionError:
+                stream.cancelled = True
+
+        try:
+            result = await build_future
+        except Exception as e:
+            # 响应头已经发出，只能不发送结束块直接断开，客户端会收到不完整的响应
+            self.failed += 1
+            if stream.cancelled:
+                logger.warning("⚠️ 客户端在传输过程中断开，已停止生成")
+            else:
+                logger.error(f"❌ 生成失败: {e}")
+            return
+        if stream.cancelled:
+            self.failed += 1
+            return
+
+        writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        self.completed += 1
+        logger.info(f"已发送 {result.count} 张图片的工作簿，{stream.bytes_sent} 字节，"
+                    f"耗时 {time.perf_counter() - start:.2f} 秒")
+        if logger.isEnabledFor(logging.DEBUG):
+            for line in wps.format_stages(result.report):
+                logger.debug(line)
+
+
+# 客户端请求中的图片：路径原样发送，内存中的图片（bytes或ImageSource）以base64发送
+def encode_image(source):
+    if isinstance(source, wps.ImageSource):
+        return {'data': base64.b64encode(source.data).decode('ascii'), 'name': source.name}
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return {'data': base64.b64encode(source).decode('ascii')}
+    return os.fspath(source)
+
+
+# 本地客户端：请求服务生成工作簿并保存到output，返回写入的字节数。
+# 图片可以是服务目录内的路径或内存中的图片数据，
+# unix_path不为None时通过Unix socket连接，否则通过TCP连接host:port
+async def request_workbook(output, images=None, mapping=None, host='127.0.0.1',
+                           port=DEFAULT_PORT, unix_path=None, **options):
+    if unix_path is not None:
+        reader, writer = await asyncio.open_unix_connection(unix_path)
+    else:
+        reader, writer = await asyncio.open_connection(host, port)
+
+    payload = dict(options)
+    if mapping is not None:
+        payload['mapping'] = [[sheet, cell, encode_image(image)] for sheet, cell, image in mapping]
+    else:
+        payload['images'] = [encode_image(image) for image in images or []]
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    writer.write(
+        f'POST /embed HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+        f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body
+    )
+    await writer.drain()
+
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        status = int(lines[0].split(' ', 2)[1])
+        headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+        if status != 200:
+            data = await reader.read()
+            try:
+                message = json.loads(data)['error']
+            except (ValueError, KeyError):
+                message = data.decode('utf-8', 'replace')
+            raise RuntimeError(f"服务返回 {status}: {message}")
+
+        size = 0
+        try:
+            with open(output, 'wb') as f:
+                while True:
+                    chunk_size = int((await reader.readuntil(b'\r\n')).strip(), 16)
+                    if chunk_size == 0:
+                        break
+                    f.write(await reader.readexactly(chunk_size))
+                    await reader.readexactly(2)
+                    size += chunk_size
+        except (asyncio.IncompleteReadError, ValueError):
+            os.remove(output)
+            raise ConnectionError("响应不完整，服务端生成失败或连接中断")
+        return size
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def serve(args):
+    cache = wps.ImageCache(args.cache_dir, args.cache_size) if args.cache_dir else None
+    service = EmbedService(args.root, args.workers, args.max_concurrent, args.max_queue, cache)
+    if args.unix:
+        server = await asyncio.start_unix_server(service.handle, path=args.unix)
+        address = args.unix
+    else:
+        server = await asyncio.start_server(service.handle, args.host, args.port)
+        address = f'http://{args.host}:{args.port}'
+    logger.info(f"服务已启动: {address}（图片目录 {service.root}，"
+                f"最多同时生成 {args.max_concurrent} 个工作簿，{args.workers} 个准备线程）")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='WPS内嵌图片服务')
+    parser.add_argument('--log-level', default='INFO',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], help='日志级别')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    server = subparsers.add_parser('serve', help='启动服务')
+    server.add_argument('--host', default='127.0.0.1', help='监听地址')
+    server.add_argument('--port', type=int, default=DEFAULT_PORT, help='监听端口')
+    server.add_argument('--unix', help='监听Unix socket而不是TCP端口')
+    server.add_argument('--root', default='.', help='图片目录，请求中的图片路径必须位于其中')
+    server.add_argument('--workers', type=int, default=wps.DEFAULT_WORKERS,
+                        help='所有请求共用的图片准备线程数')
+    server.add_argument('--max-concurrent', type=int, default=2, help='同时生成的工作簿数')
+    server.add_argument('--max-queue', type=int, default=8, help='排队请求数上限，超出时返回503')
+    server.add_argument('--cache-dir', help='已处理图片的缓存目录')
+    server.add_argument('--cache-size', type=int, default=wps.DEFAULT_CACHE_SIZE,
+                        help='缓存容量上限（字节）')
+
+    client = subparsers.add_parser('client', help='请求服务生成工作簿')
+    client.add_argument('images', nargs='+', help='图片路径（相对于服务的图片目录）')
+    client.add_argument('-o', '--output', default=wps.OUTPUT_EXCEL, help='输出文件')
+    client.add_argument('--host', default='127.0.0.1', help='服务地址')
+    client.add_argument('--port', type=int, default=DEFAULT_PORT, help='服务端口')
+    client.add_argument('--unix', help='通过Unix socket连接')
+    client.add_argument('--per-row', type=int, default=0, help='每行放几张图片')
+    client.add_argument('--fit-to-cell', action='store_true', help='把图片缩小到单元格大小')
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level, format='%(asctime)s %(message)s', stream=sys.stdout)
+    if args.command == 'serve':
+        try:
+            asyncio.run(serve(args))
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    try:
+        size = asyncio.run(request_workbook(
+            args.output, args.images, host=args.host, port=args.port, unix_path=args.unix,
+            per_row=args.per_row, fit_to_cell=args.fit_to_cell
+        ))
+    except (OSError, RuntimeError) as e:
+        logger.error(f"❌ {e}")
+        return 1
+    logger.info(f"✅ 已保存 {args.output}（{size} 字节）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())